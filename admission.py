@@ -0,0 +1,160 @@
+"""Job admission: cost estimates, token reservations and per-plan limits.
+
+A job's cost is estimated at submit time from the probes (resolution,
+duration), file count, batch size and encode profile; /batch jobs are
+probed, and so charged, by the worker. Each plan includes a
+few tokens per job; anything above that is reserved from ``User.tokens``
+with a conditional UPDATE in the same transaction that queues the job, so
+two submits can never spend the same tokens; the user's row stays locked
+until then, which also keeps the queued-jobs cap exact. Tokens for variants that
+fail are refunded when the job finishes.
+
+Plans also cap how many jobs a user may have queued and running, and
+(applied by retention.py) how long and how much output is kept. Free-tier
+jobs share ``FREE_JOB_SLOTS`` workers, so paying plans always find capacity.
+"""
+import datetime
+import math
+
+from flask import current_app
+
+# 'max_batch' caps batch_size, 'included_tokens' is free per job, lower
+# 'priority' is claimed first. retention.py keeps 'history_days' of outputs
+# and at most 'quota_mb' of them per user. Any plan not listed is a paid plan.
+PLAN_LIMITS = {
+    'free': {'max_running': 1, 'max_queued': 2, 'max_batch': 10, 'included_tokens': 2, 'priority': 1,
+             'history_days': 7, 'quota_mb': 1024},
+}
+PAID_LIMITS = {'max_running': 3, 'max_queued': 20, 'max_batch': 50, 'included_tokens': 5, 'priority': 0,
+               'history_days': 90, 'quota_mb': 20 * 1024}
+FREE_PLANS = ('free', None)
+
+IMAGE_MEGAPIXELS_PER_TOKEN = 50   # variant-megapixels
+VIDEO_SECONDS_PER_TOKEN = 60      # variant-seconds of 1080p at the medium profile
+PROFILE_WEIGHT = {'ultrafast': 0.5, 'veryfast': 0.75, 'medium': 1.0}
+
+class Rejected(Exception):
+    def __init__(self, message, status=429, **extra):
+        super().__init__(message)
+        self.status = status
+        self.extra = extra
+
+def get_models():
+    from app import db, Job, User
+    return db, Job, User
+
+def limits_for(plan):
+    return PLAN_LIMITS.get(plan or 'free', PAID_LIMITS)
+
+# -------------------- Cost --------------------
+def _work(kind, info, opts):
+    if kind == 'images':
+        return info['width'] * info['height'] / 1e6 * opts['batch_size'] / IMAGE_MEGAPIXELS_PER_TOKEN
+    weight = PROFILE_WEIGHT.get(opts.get('encode_profile'), 1.0)
+    seconds = info['width'] * info['height'] / (1920 * 1080) * info['duration']
+    return seconds * opts['batch_size'] * weight / VIDEO_SECONDS_PER_TOKEN
+
+def estimate_cost(kind, probes, opts, file_opts=None):
+    """Tokens a job is worth before any plan allowance.
+
+    ``file_opts`` maps filename to options replacing ``opts`` for that file.
+    """
+    file_opts = file_opts or {}
+    work = sum(_work(kind, info, file_opts.get(f, opts)) for f, info in probes.items())
+    return max(1, math.ceil(work))
+
+# -------------------- Admit / Refund --------------------
+def _take_tokens(user_id, charge):
+    _, _, User = get_models()
+    return User.query.filter(User.id == user_id, User.tokens >= charge).update(
+        {User.tokens: User.tokens - charge}, synchronize_session=False)
+
+def _needs(charge):
+    return Rejected(f"this job needs {charge} token{'s' if charge != 1 else ''}", 402,
+                    tokens_required=charge)
+
+def admit(user, kind, probes, opts, file_opts=None):
+    """Check plan limits and reserve the job's tokens; returns tokens charged.
+
+    The reservation is left uncommitted so it lands together with the job
+    row; raises Rejected (with an HTTP status) instead. With ``probes=None``
+    only the limits are checked and the worker charges the job with
+    ``reserve`` once it has probed the inputs.
+    """
+    db, Job, User = get_models()
+    limits = limits_for(user.plan)
+    for o in [opts, *(file_opts or {}).values()]:
+        if o['batch_size'] < 1 or o['batch_size'] > limits['max_batch']:
+            raise Rejected(f"batch size must be between 1 and {limits['max_batch']} on your plan", 400)
+    # lock the user's row first: a concurrent submit waits here until this
+    # job is queued (or rejected), so both can't pass the count below
+    User.query.filter_by(id=user.id).update({User.tokens: User.tokens}, synchronize_session=False)
+    outstanding = Job.query.filter(Job.user_id == user.id,
+                                   Job.status.in_(('queued', 'running'))).count()
+    if outstanding >= limits['max_queued']:
+        db.session.rollback()
+        raise Rejected(f"you already have {outstanding} jobs in progress; wait for one to finish")
+    if probes is None:
+        return 0
+    charge = max(0, estimate_cost(kind, probes, opts, file_opts) - limits['included_tokens'])
+    if charge and not _take_tokens(user.id, charge):
+        db.session.rollback()
+        raise _needs(charge)
+    return charge
+
+def reserve(job, probes, opts, file_opts=None):
+    """Charge a job admitted without probes, from the worker; the caller commits."""
+    db, _, User = get_models()
+    user = db.session.get(User, job.user_id)
+    charge = max(0, estimate_cost(job.kind, probes, opts, file_opts)
+                 - limits_for(user.plan)['included_tokens'])
+    if charge and not _take_tokens(user.id, charge):
+        raise _needs(charge)
+    job.cost = charge
+    return charge
+
+def refund(job, tokens):
+    """Give ``tokens`` of a job's charge back; the caller commits."""
+    db, _, User = get_models()
+    tokens = min(tokens, job.cost or 0)
+    if tokens > 0:
+        User.query.filter_by(id=job.user_id).update(
+            {User.tokens: User.tokens + tokens}, synchronize_session=False)
+        job.cost -= tokens
+    return tokens
+
+def settle(job, variants_total, variants_failed):
+    """Refund the share of a finished job's charge that produced nothing."""
+    if job.status != 'done':
+        return refund(job, job.cost or 0)
+    return refund(job, (job.cost or 0) * variants_failed // max(variants_total, 1))
+
+# -------------------- Claiming --------------------
+def claim_priority(User):
+    """SQL sort key for a job's owner: the plan's 'priority', lowest claimed first."""
+    from sqlalchemy import case, func
+    return case({plan: limits['priority'] for plan, limits in PLAN_LIMITS.items()},
+                value=func.coalesce(User.plan, 'free'), else_=PAID_LIMITS['priority'])
+
+def claim_filters(Job, User, plan):
+    """Extra WHERE clauses for claiming a queued job of a ``plan`` user."""
+    from sqlalchemy import func, select
+    from jobs import utcnow
+    db, _, _ = get_models()
+    running = db.aliased(Job)
+    # a job whose heartbeat stopped is about to be reaped; it holds no slot
+    cutoff = utcnow() - datetime.timedelta(seconds=current_app.config['JOB_LOST_SECONDS'])
+    alive = (running.status == 'running',
+             func.coalesce(running.updated_at, running.started_at) >= cutoff)
+    user_running = (select(func.count()).select_from(running)
+                    .where(running.user_id == Job.user_id, *alive)
+                    .scalar_subquery())
+    filters = [user_running < limits_for(plan)['max_running']]
+    if plan in FREE_PLANS:
+        owner = db.aliased(User)
+        free_running = (select(func.count()).select_from(running)
+                        .join(owner, owner.id == running.user_id)
+                        .where(*alive, func.coalesce(owner.plan, 'free') == 'free')
+                        .scalar_subquery())
+        filters.append(free_running < current_app.config['FREE_JOB_SLOTS'])
+    return filters
@@ -7,45 +7,50 @@ load_dotenv()
 from flask import (
     Flask, render_template, request, redirect,
     url_for, flash, session, send_file,
-    send_from_directory, jsonify
+    send_from_directory, jsonify, current_app
 )
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from flask_login import (
     LoginManager, login_user, logout_user,
     login_required, UserMixin, current_user
 )
 from werkzeug.security import generate_password_hash, check_password_hash
-from pydrive.auth import GoogleAuth
-from pydrive.drive import GoogleDrive
-from PIL import Image, ImageEnhance
+import click
 import random
-import zipfile
-import shutil
 import datetime
 import os
-import ffmpeg
+import shutil
+import string
 
 # Import billing blueprints
 from billing import subscription_bp, referral_bp
-
-# -------------------- App & DB Setup --------------------
-app = Flask(__name__)
-app.secret_key = os.getenv('FLASK_SECRET_KEY', 'please_change_me')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
-
-# -------------------- Login Manager --------------------
+from jobs import jobs_bp, new_job_id, spool_dir, enqueue
+from ingest import SpoolingRequest, claim_upload, discard_upload, discard_unclaimed_spool
+from processing import parse_options
+from metrics import metrics_bp
+from thumbnails import thumbs_bp
+from batch import batch_bp, unique_name
+import admission
+import database
+import metrics
+import probe
+import retention
+
+# -------------------- Extensions --------------------
+# bound to an app by create_app()
+db = SQLAlchemy()
 login_manager = LoginManager()
 login_manager.login_view = 'login'
-login_manager.init_app(app)
 
-# -------------------- Folders --------------------
-for folder in ('uploads', 'processed', 'static/history', 'static/processed_zips'):
-    os.makedirs(folder, exist_ok=True)
+# views are collected here and added to every app by create_app(), under
+# their plain endpoint names ('login', 'history', ...)
+_views = []
+
+def route(rule, **options):
+    def decorator(view):
+        _views.append((rule, view, options))
+        return view
+    return decorator
 
 # -------------------- Models --------------------
 class User(UserMixin, db.Model):
@@ -69,17 +74,63 @@ class User(UserMixin, db.Model):
         'User', backref=db.backref('referrer', remote_side=[id]), lazy='dynamic'
     )
 
+class Job(db.Model):
+    id           = db.Column(db.String(32), primary_key=True)
+    user_id      = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    kind         = db.Column(db.String(10), nullable=False)  # 'images' | 'videos'
+    status       = db.Column(db.String(20), default='queued', index=True)
+    params       = db.Column(db.Text, nullable=False)
+    progress     = db.Column(db.Text)
+    zip_filename = db.Column(db.String(200))
+    error        = db.Column(db.Text)
+    cost         = db.Column(db.Integer, default=0)  # tokens charged, net of refunds
+    created_at   = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    started_at   = db.Column(db.DateTime)
+    updated_at   = db.Column(db.DateTime)  # heartbeat while running
+    finished_at  = db.Column(db.DateTime)
+
+class Backup(db.Model):
+    id           = db.Column(db.Integer, primary_key=True)
+    host         = db.Column(db.String(255), nullable=False, index=True)  # whose disk holds path
+    path         = db.Column(db.String(500), nullable=False)
+    name         = db.Column(db.String(200), nullable=False)  # name in the backup
+    delete_after = db.Column(db.Boolean, default=False, nullable=False)
+    claimed_at   = db.Column(db.DateTime)  # set while a process uploads it
+    created_at   = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+
+class JobFailure(db.Model):
+    id      = db.Column(db.Integer, primary_key=True)
+    job_id  = db.Column(db.String(32), db.ForeignKey('job.id'), nullable=False, index=True)
+    file    = db.Column(db.String(255), nullable=False)  # input file the variant was for
+    variant = db.Column(db.Integer, nullable=False)  # 1-based
+    error   = db.Column(db.Text)
+
+class ProcessedFile(db.Model):
+    id         = db.Column(db.Integer, primary_key=True)
+    user_id    = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    job_id     = db.Column(db.String(32), db.ForeignKey('job.id'), nullable=True, index=True)
+    filename   = db.Column(db.String(255), nullable=False, unique=True)  # name in static/history
+    source     = db.Column(db.String(255))  # input file it was rendered from
+    sha256     = db.Column(db.String(64), nullable=False)
+    size       = db.Column(db.BigInteger, nullable=False)
+    kind       = db.Column(db.String(10), nullable=False)  # 'image' | 'video'
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_processed_file_user_created', 'user_id', 'created_at', 'id'),
+    )
+
 @login_manager.user_loader
 def load_user(user_id):
     return db.session.get(User, int(user_id))
 
 # -------------------- Auth & Referral --------------------
-@app.route('/apply-referral/<code>')
+@route('/apply-referral/<code>')
 def apply_referral(code):
     session['referral_code'] = code
     return redirect(url_for('register'))
 
-@app.route('/register', methods=['GET', 'POST'])
+@route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         email, password = request.form['email'], request.form['password']
@@ -97,11 +148,12 @@ def register():
             ref = User.query.filter_by(referral_code=code).first()
             if ref and ref.id != new_user.id:
                 new_user.referred_by_id = ref.id
-                ref.tokens += 10
-                db.session.add(ref)
+                # SQL-side increment: concurrent credits must not overwrite each other
+                User.query.filter_by(id=ref.id).update(
+                    {User.tokens: User.tokens + 10}, synchronize_session=False)
         # generate referral code
         new_user.referral_code = ''.join(
-            random.choices(random.choices.__defaults__[0] + random.choices.__defaults__[1], k=8)
+            random.choices(string.ascii_uppercase + string.digits, k=8)
         )
         db.session.add(new_user)
         db.session.commit()
@@ -109,7 +161,7 @@ def register():
         return redirect(url_for('login'))
     return render_template('register.html')
 
-@app.route('/login', methods=['GET', 'POST'])
+@route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         email, password = request.form['email'], request.form['password']
@@ -120,7 +172,7 @@ def login():
         flash('❌ Login failed. Check your credentials.', 'error')
     return render_template('login.html')
 
-@app.route('/logout')
+@route('/logout')
 @login_required
 def logout():
     logout_user()
@@ -128,7 +180,7 @@ def logout():
     return redirect(url_for('login'))
 
 # -------------------- Settings --------------------
-@app.route('/settings', methods=['GET', 'POST'])
+@route('/settings', methods=['GET', 'POST'])
 @login_required
 def settings():
     if request.method == 'POST':
@@ -142,191 +194,215 @@ def settings():
     return render_template('settings.html', referral_link=referral_link)
 
 # -------------------- Plans Page --------------------
-@app.route('/plans')
+@route('/plans')
 @login_required
 def plans():
     key = os.getenv('STRIPE_PUBLISHABLE_KEY')
     return render_template('plans.html', stripe_publishable_key=key)
 
 # -------------------- Stripe Key API --------------------
-@app.route('/stripe-key')
+@route('/stripe-key')
 @login_required
 def stripe_key():
     return jsonify({'publishableKey': os.getenv('STRIPE_PUBLISHABLE_KEY')})
 
 # -------------------- UI Pages --------------------
-@app.route('/')
+@route('/')
 @login_required
 def home():
     return render_template('home.html')
 
-@app.route('/image-processor')
+@route('/image-processor')
 @login_required
 def image_processor():
     return render_template('image_processor.html')
 
-@app.route('/video-processor')
+@route('/video-processor')
 @login_required
 def video_processor():
     return render_template('video_processor.html')
 
 # -------------------- History --------------------
-@app.route('/history')
+@route('/history')
 @login_required
 def history():
-    page = int(request.args.get('page', 1))
+    # keyset pagination over (created_at, id): cost is independent of history size
     per_page = 25
-    history_folder = os.path.join('static', 'history')
-    all_files = sorted(
-        os.listdir(history_folder),
-        key=lambda x: os.path.getmtime(os.path.join(history_folder, x)),
-        reverse=True
-    )
-    total_pages = (len(all_files) + per_page - 1) // per_page
-    files = all_files[(page-1)*per_page:page*per_page]
-    return render_template('history.html', files=files, page=page, total_pages=total_pages)
-
-@app.route('/download/<filename>')
+    mine = ProcessedFile.query.filter_by(user_id=current_user.id)
+    key = lambda anchor: db.or_(
+        ProcessedFile.created_at < anchor.created_at,
+        db.and_(ProcessedFile.created_at == anchor.created_at, ProcessedFile.id < anchor.id))
+    newer = lambda anchor: db.or_(
+        ProcessedFile.created_at > anchor.created_at,
+        db.and_(ProcessedFile.created_at == anchor.created_at, ProcessedFile.id > anchor.id))
+    before = mine.filter_by(id=request.args.get('before', type=int)).first()
+    after = mine.filter_by(id=request.args.get('after', type=int)).first()
+    if after:
+        rows = (mine.filter(newer(after))
+                .order_by(ProcessedFile.created_at.asc(), ProcessedFile.id.asc())
+                .limit(per_page + 1).all())
+        has_newer, rows = len(rows) > per_page, rows[:per_page][::-1]
+        has_older = True
+    else:
+        q = mine.filter(key(before)) if before else mine
+        rows = (q.order_by(ProcessedFile.created_at.desc(), ProcessedFile.id.desc())
+                .limit(per_page + 1).all())
+        has_older, rows = len(rows) > per_page, rows[:per_page]
+        has_newer = before is not None
+    return render_template('history.html', files=rows,
+                           newer_cursor=rows[0].id if rows and has_newer else None,
+                           older_cursor=rows[-1].id if rows and has_older else None)
+
+@route('/download/<filename>')
 @login_required
 def download_file(filename):
+    ProcessedFile.query.filter_by(user_id=current_user.id, filename=filename).first_or_404()
     return send_from_directory('static/history', filename, as_attachment=True)
 
-@app.route('/download-zip/<filename>')
+@route('/download-zip/<filename>')
 @login_required
 def download_zip(filename):
     return send_from_directory('static/processed_zips', filename, as_attachment=True)
 
-# -------------------- Google Drive Backup --------------------
-def upload_to_google_drive(file_path, filename):
-    gauth = GoogleAuth()
-    gauth.LoadCredentialsFile("credentials.json")
-    if gauth.credentials is None:
-        gauth.LocalWebserverAuth()
-    elif gauth.access_token_expired:
-        gauth.Refresh()
-    else:
-        gauth.Authorize()
-    gauth.SaveCredentialsFile("credentials.json")
-
-    drive = GoogleDrive(gauth)
-    folder_list = drive.ListFile({'q': "title='MetadataChangerBackup' and mimeType='application/vnd.google-apps.folder' and trashed=false"}).GetList()
-    if folder_list:
-        folder_id = folder_list[0]['id']
-    else:
-        folder = drive.CreateFile({'title': 'MetadataChangerBackup', 'mimeType': 'application/vnd.google-apps.folder'})
-        folder.Upload()
-        folder_id = folder['id']
-    file_drive = drive.CreateFile({'title': filename, 'parents': [{'id': folder_id}]})
-    file_drive.SetContentFile(file_path)
-    file_drive.Upload()
-
-# -------------------- Helpers --------------------
-def scale_range(min_val, max_val, intensity):
-    factor = intensity / 100
-    return random.uniform(min_val*factor, max_val*factor)
-
-# -------------------- Process Images --------------------
-@app.route('/process-images', methods=['POST'])
+# -------------------- Process Images / Videos --------------------
+def submit_job(kind, field):
+    # touching request.files parses the multipart body, spooling every upload
+    with metrics.span('upload'):
+        uploads = request.files.getlist(field)
+    opts = parse_options(request.form)
+    # uploads were already streamed into this job's spool dir while parsing
+    job_id = request.spool_id or new_job_id()
+    folder = spool_dir(job_id)
+    filenames, checksums, probes = [], {}, {}
+    taken = set()
+    for upload in uploads:
+        filename = os.path.basename(upload.filename or '')
+        if filename in ('', '.', '..'):
+            discard_upload(upload)
+            continue
+        # two parts named "a.jpg" must not overwrite each other's source
+        filename = unique_name(filename, taken)
+        checksums[filename] = claim_upload(upload, folder, filename)
+        filenames.append(filename)
+    if not filenames:
+        shutil.rmtree(folder, ignore_errors=True)
+        return jsonify({'error': 'No files uploaded.'}), 400
+    metrics.inc('bytes_in_total', sum(os.path.getsize(os.path.join(folder, f)) for f in filenames),
+                kind=kind)
+    # reject unsupported inputs before anything is queued
+    try:
+        with metrics.span('probe'):
+            for filename in filenames:
+                info = probe.probe(os.path.join(folder, filename), kind.rstrip('s'), checksums[filename])
+                probes[filename] = probe.check_supported(info, current_app.config['MAX_SOURCE_PIXELS'])
+    except probe.UnsupportedMedia as e:
+        shutil.rmtree(folder, ignore_errors=True)
+        return jsonify({'error': f'{filename}: {e}'}), 400
+    try:
+        cost = admission.admit(current_user, kind, probes, opts)
+    except admission.Rejected as e:
+        shutil.rmtree(folder, ignore_errors=True)
+        return jsonify({'error': str(e), **e.extra}), e.status
+    profile = current_app.config['PROFILE_JOBS'] and request.form.get('profile') == '1'
+    enqueue(job_id, kind, current_user.id, opts, filenames, checksums, probes, profile=profile,
+            cost=cost)
+    return jsonify({'job_id': job_id, 'status_url': url_for('jobs.job_status', job_id=job_id)}), 202
+
+@route('/process-images', methods=['POST'])
 @login_required
 def process_images():
-    images = request.files.getlist('images')
-    batch_size = int(request.form.get('batch_size', 5))
-    intensity = int(request.form.get('intensity', 30))
-    adjust_contrast = 'adjust_contrast' in request.form
-    adjust_brightness = 'adjust_brightness' in request.form
-    rotate = 'rotate' in request.form
-    crop = 'crop' in request.form
-    flip_horizontal = 'flip_horizontal' in request.form
-
-    timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-    output_folder = os.path.join('processed', timestamp)
-    os.makedirs(output_folder, exist_ok=True)
-
-    for image_file in images:
-        img = Image.open(image_file)
-        base = os.path.splitext(image_file.filename)[0]
-        for i in range(batch_size):
-            var = img.copy()
-            if adjust_contrast:
-                var = ImageEnhance.Contrast(var).enhance(1 + scale_range(-0.1,0.1,intensity))
-            if adjust_brightness:
-                var = ImageEnhance.Brightness(var).enhance(1 + scale_range(-0.1,0.1,intensity))
-            if rotate:
-                var = var.rotate(scale_range(-5,5,intensity), expand=True)
-            if crop:
-                w,h = var.size
-                dx,dy = int(w*scale_range(0.01,0.05,intensity)), int(h*scale_range(0.01,0.05,intensity))
-                var = var.crop((dx,dy,w-dx,h-dy))
-            if flip_horizontal and random.random()>0.5:
-                var = var.transpose(Image.FLIP_LEFT_RIGHT)
-            fname = f"{base}_variant_{i+1}.jpg"
-            var.save(os.path.join(output_folder, fname))
-            var.save(os.path.join('static/history', fname))
-
-    zip_fn = f"images_{timestamp}.zip"
-    zip_path = os.path.join('static/processed_zips', zip_fn)
-    with zipfile.ZipFile(zip_path,'w') as zf:
-        for f in os.listdir(output_folder): zf.write(os.path.join(output_folder,f), arcname=f)
-    shutil.rmtree(output_folder)
-    if current_user.backup_enabled:
-        upload_to_google_drive(zip_path, zip_fn)
-    return jsonify({'zip_filename': zip_fn})
-
-# -------------------- Process Videos --------------------
-@app.route('/process-videos', methods=['POST'])
+    return submit_job('images', 'images')
+
+@route('/process-videos', methods=['POST'])
 @login_required
 def process_videos():
-    videos = request.files.getlist('videos')
-    batch_size = int(request.form.get('batch_size', 5))
-    intensity = int(request.form.get('intensity', 30))
-    adjust_contrast = 'adjust_contrast' in request.form
-    adjust_brightness = 'adjust_brightness' in request.form
-    rotate = 'rotate' in request.form
-    crop = 'crop' in request.form
-    flip_horizontal = 'flip_horizontal' in request.form
-
-    timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-    output_folder = os.path.join('processed', timestamp)
-    os.makedirs(output_folder, exist_ok=True)
-
-    for video_file in videos:
-        src = os.path.join('uploads', video_file.filename)
-        video_file.save(src)
-        probe = ffmpeg.probe(src)
-        v_stream = next(s for s in probe['streams'] if s['codec_type']=='video')
-        w,h = int(v_stream['width']), int(v_stream['height'])
-        base = os.path.splitext(video_file.filename)[0]
-        for i in range(batch_size):
-            outp = os.path.join(output_folder, f"{base}_variant_{i+1}.mp4")
-            hist = os.path.join('static/history', f"{base}_variant_{i+1}.mp4")
-            st = ffmpeg.input(src)
-            if adjust_contrast or adjust_brightness:
-                c = 1+scale_range(-0.1,0.1,intensity) if adjust_contrast else 1
-                b = scale_range(-0.05,0.05,intensity) if adjust_brightness else 0
-                st = st.filter('eq',contrast=c,brightness=b)
-            if rotate:
-                st = st.filter('rotate', scale_range(-2,2,intensity)*3.1415/180)
-            if crop:
-                dx,dy = int(w*scale_range(0.01,0.03,intensity)), int(h*scale_range(0.01,0.03,intensity))
-                st = st.filter('crop', w-2*dx, h-2*dy, dx, dy).filter('scale', w, h)
-            if flip_horizontal and random.random()>0.5:
-                st = st.filter('hflip')
-            stream = ffmpeg.output(st, outp, vcodec='libx264', acodec='aac')
-            ffmpeg.run(stream, overwrite_output=True)
-            shutil.copy(outp, hist)
-        os.remove(src)
-    zip_fn = f"videos_{timestamp}.zip"
-    zip_path = os.path.join('static/processed_zips', zip_fn)
-    with zipfile.ZipFile(zip_path,'w') as zf:
-        for f in os.listdir(output_folder): zf.write(os.path.join(output_folder,f), arcname=f)
-    shutil.rmtree(output_folder)
-    if current_user.backup_enabled:
-        upload_to_google_drive(zip_path, zip_fn)
-    return jsonify({'zip_filename': zip_fn})
-
-# -------------------- Blueprints --------------------
-app.register_blueprint(subscription_bp, url_prefix='/subscription')
-app.register_blueprint(referral_bp, url_prefix='/referral')
+    return submit_job('videos', 'videos')
+
+# -------------------- App Factory --------------------
+def create_app(config=None):
+    """Build the app; ``config`` overrides settings read from the environment.
+
+    Importing this module loads Flask and SQLAlchemy only: PIL, ffmpeg,
+    stripe and pydrive are imported where they are first used, so a worker
+    that only serves pages never loads them (see gunicorn.conf.py).
+    """
+    app = Flask(__name__)
+    app.request_class = SpoolingRequest
+    app.secret_key = os.getenv('FLASK_SECRET_KEY', 'please_change_me')
+    app.config['SQLALCHEMY_DATABASE_URI'] = database.database_url(os.getenv('DATABASE_URL'))
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_UPLOAD_MB', 2048)) * 1024 * 1024
+    app.config['JOB_WORKERS'] = int(os.getenv('JOB_WORKERS', 2))
+    app.config['JOB_WORKERS_EMBEDDED'] = os.getenv('JOB_WORKERS_EMBEDDED', '1') == '1'
+    app.config['JOB_HEARTBEAT'] = float(os.getenv('JOB_HEARTBEAT', 15))  # seconds between running-job heartbeats
+    app.config['JOB_LOST_SECONDS'] = float(os.getenv('JOB_LOST_SECONDS', 120))  # no heartbeat this long = reaped
+    app.config['BACKUP_BACKEND'] = os.getenv('BACKUP_BACKEND', 'drive')  # drive | local
+    app.config['BACKUP_LOCAL_DIR'] = os.getenv('BACKUP_LOCAL_DIR', os.path.join('backups', 'local'))
+    app.config['BACKUP_WORKERS'] = int(os.getenv('BACKUP_WORKERS', 1))
+    app.config['BACKUP_RETRIES'] = int(os.getenv('BACKUP_RETRIES', 5))
+    app.config['BACKUP_RETRY_DELAY'] = float(os.getenv('BACKUP_RETRY_DELAY', 2.0))
+    app.config['PROBE_CACHE_SIZE'] = int(os.getenv('PROBE_CACHE_SIZE', 1024))
+    app.config['PROBE_RETENTION_DAYS'] = float(os.getenv('PROBE_RETENTION_DAYS', 30))  # on-disk probe cache
+    app.config['MAX_SOURCE_PIXELS'] = int(os.getenv('MAX_SOURCE_PIXELS', 8192*8192))
+    app.config['ARCHIVE_MODE'] = os.getenv('ARCHIVE_MODE', 'stream')  # stream | stored
+    app.config['FFMPEG_MAX_PROCS'] = int(os.getenv('FFMPEG_MAX_PROCS', 0))  # per host, 0 = one per CPU
+    app.config['ENCODE_PROFILE'] = os.getenv('ENCODE_PROFILE', 'medium')  # ultrafast | veryfast | medium
+    app.config['VIDEO_RENDER_MODE'] = os.getenv('VIDEO_RENDER_MODE', 'auto')  # auto | split | per_variant | segmented
+    app.config['IMAGE_WORKERS'] = int(os.getenv('IMAGE_WORKERS', 0))  # 0 = one per CPU, 1 = inline
+    app.config['IMAGE_PIPELINE'] = os.getenv('IMAGE_PIPELINE', 'fused')  # fused | chained
+    app.config['VIDEO_SPLIT_MIN_PIXELS'] = int(os.getenv('VIDEO_SPLIT_MIN_PIXELS', 1280*720))
+    app.config['VIDEO_SEGMENT_SECONDS'] = float(os.getenv('VIDEO_SEGMENT_SECONDS', 60))
+    app.config['VIDEO_SEGMENT_MIN_SECONDS'] = float(os.getenv('VIDEO_SEGMENT_MIN_SECONDS', 600))  # auto mode
+    app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')  # unset = /metrics is open
+    app.config['PROFILE_JOBS'] = os.getenv('PROFILE_JOBS', '0') == '1'  # honour profile=1 on submit
+    app.config['THUMB_CACHE_MB'] = int(os.getenv('THUMB_CACHE_MB', 512))
+    app.config['RETENTION_EMBEDDED'] = os.getenv('RETENTION_EMBEDDED', '1') == '1'
+    app.config['RETENTION_INTERVAL'] = float(os.getenv('RETENTION_INTERVAL', 60))
+    app.config['RETENTION_BATCH'] = int(os.getenv('RETENTION_BATCH', 200))  # deletions per sweep step
+    app.config['RETENTION_IOPS'] = float(os.getenv('RETENTION_IOPS', 50))
+    app.config['ORPHAN_GRACE'] = int(os.getenv('ORPHAN_GRACE', 6 * 3600))
+    app.config['ZIP_RETENTION_DAYS'] = float(os.getenv('ZIP_RETENTION_DAYS', 2))
+    app.config['SOURCE_RETENTION_DAYS'] = float(os.getenv('SOURCE_RETENTION_DAYS', 7))  # /batch/uploads
+    # directories (os.pathsep-separated) that batch manifests may read server paths from
+    app.config['BATCH_ROOTS'] = [os.path.realpath(p) for p in os.getenv('BATCH_ROOTS', '').split(os.pathsep) if p]
+    app.config['BATCH_MAX_FILES'] = int(os.getenv('BATCH_MAX_FILES', 5000))
+    # workers free-plan jobs may occupy at once; the rest are kept for paid plans
+    app.config['FREE_JOB_SLOTS'] = int(os.getenv('FREE_JOB_SLOTS', max(1, app.config['JOB_WORKERS'] // 2)))
+    app.config.update(config or {})
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', database.engine_options(
+        app.config['SQLALCHEMY_DATABASE_URI'],
+        pool_size=int(os.getenv('DB_POOL_SIZE', 5)),
+        max_overflow=int(os.getenv('DB_MAX_OVERFLOW', 10)),
+        pool_timeout=float(os.getenv('DB_POOL_TIMEOUT', 30)),
+        pool_recycle=int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        busy_timeout=float(os.getenv('DB_BUSY_TIMEOUT', 15)),  # SQLite only
+    ))
+
+    probe.configure(app.config['PROBE_CACHE_SIZE'])
+    db.init_app(app)
+    if click.get_current_context(silent=True) is not None:
+        # `flask db ...`: alembic is only needed by the migration commands
+        from flask_migrate import Migrate
+        Migrate(app, db)
+    login_manager.init_app(app)
+
+    for folder in ('uploads', 'processed', 'static/history', 'static/processed_zips', 'storage/blobs',
+                   'storage/probes', 'storage/results', 'storage/sources', 'storage/thumbs', 'backups/pending'):
+        os.makedirs(folder, exist_ok=True)
+
+    for rule, view, options in _views:
+        app.add_url_rule(rule, view_func=view, **options)
+    app.register_blueprint(subscription_bp, url_prefix='/subscription')
+    app.register_blueprint(referral_bp, url_prefix='/referral')
+    app.register_blueprint(jobs_bp, url_prefix='/jobs')
+    app.register_blueprint(metrics_bp)
+    app.register_blueprint(thumbs_bp, url_prefix='/thumbs')
+    app.register_blueprint(batch_bp, url_prefix='/batch')
+    app.teardown_request(discard_unclaimed_spool)
+    app.before_request(retention.start_embedded)
+    return app
+
+app = create_app()
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,61 @@
+"""ZIP helpers for job outputs.
+
+JPEG and MP4 variants are already compressed, so they are stored rather
+than deflated. ``stream_zip`` yields an archive chunk by chunk for a
+download response without ever writing it to disk.
+"""
+import os
+import zipfile
+
+STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.mp4', '.mov', '.zip')
+
+def compress_type_for(name):
+    if name.lower().endswith(STORED_EXTENSIONS):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def add_file(zf, path, arcname):
+    zf.write(path, arcname=arcname, compress_type=compress_type_for(arcname))
+
+class _ChunkSink:
+    """Write-only, unseekable target; zipfile falls back to data descriptors."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def stream_zip(entries, chunk_size=1 << 20):
+    """Yield a ZIP archive of ``(arcname, path)`` entries as it is built."""
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w') as zf:
+        for arcname, path in entries:
+            if not os.path.exists(path):
+                continue
+            info = zipfile.ZipInfo.from_file(path, arcname)
+            info.compress_type = compress_type_for(arcname)
+            with open(path, 'rb') as src, zf.open(info, 'w') as dst:
+                for chunk in iter(lambda: src.read(chunk_size), b''):
+                    dst.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            data = sink.drain()
+            if data:
+                yield data
+    yield sink.drain()
+
+def write_zip(entries, zip_path):
+    with open(zip_path, 'wb') as f:
+        for chunk in stream_zip(entries):
+            f.write(chunk)
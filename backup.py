@@ -0,0 +1,214 @@
+"""Off-request backups of finished job archives.
+
+``submit`` records an archive as a ``Backup`` row and hands it to a small
+background executor. The executor uploads it through the configured backend
+(``BACKUP_BACKEND``) and retries with exponential backoff. Rows outlive the
+process: ``resume`` queues the ones left behind by a restart (or by a
+process that died mid-upload), and retention keeps their files until then.
+
+The Google Drive backend keeps an authorized client per thread, and the
+backup folder id, for the life of the process and uploads in resumable
+chunks. The local backend copies into a directory and stands in for Drive
+in development and tests.
+"""
+import datetime
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+PENDING_FOLDER = os.path.join('backups', 'pending')
+HOST = socket.gethostname()  # rows are uploaded by the host whose disk holds the file
+
+_lock = threading.Lock()
+_backend = None
+_executor = None
+_scheduled = set()  # Backup ids in this process's executor
+
+def get_models():
+    from app import db, Backup
+    return db, Backup
+
+def utcnow():
+    return datetime.datetime.utcnow()
+
+# -------------------- Backends --------------------
+class BackupBackend:
+    def upload(self, path, name):
+        raise NotImplementedError
+
+    def reset(self):
+        """Drop cached connections after a failure."""
+
+class LocalBackend(BackupBackend):
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def upload(self, path, name):
+        shutil.copyfile(path, os.path.join(self.folder, name))
+
+class DriveBackend(BackupBackend):
+    FOLDER_TITLE = 'MetadataChangerBackup'
+    FOLDER_MIME = 'application/vnd.google-apps.folder'
+
+    def __init__(self, credentials_file='credentials.json', chunk_size=8 * 1024 * 1024):
+        self.credentials_file = credentials_file
+        self.chunk_size = chunk_size
+        self.folder_id = None
+        # the Drive client (httplib2 underneath) is not thread-safe
+        self._local = threading.local()
+
+    def _service(self):
+        from pydrive.auth import GoogleAuth
+        gauth = getattr(self._local, 'gauth', None)
+        if gauth is None:
+            gauth = GoogleAuth()
+            gauth.LoadCredentialsFile(self.credentials_file)
+            if gauth.credentials is None:
+                raise RuntimeError(f'no Google Drive credentials in {self.credentials_file}')
+            self._local.gauth = gauth
+        if gauth.access_token_expired:
+            gauth.Refresh()
+            gauth.SaveCredentialsFile(self.credentials_file)
+            gauth.service = None
+        if gauth.service is None:
+            gauth.Authorize()
+        return gauth.service
+
+    def _folder_id(self, service):
+        if self.folder_id is None:
+            q = f"title='{self.FOLDER_TITLE}' and mimeType='{self.FOLDER_MIME}' and trashed=false"
+            items = service.files().list(q=q).execute().get('items', [])
+            if items:
+                self.folder_id = items[0]['id']
+            else:
+                folder = service.files().insert(
+                    body={'title': self.FOLDER_TITLE, 'mimeType': self.FOLDER_MIME}).execute()
+                self.folder_id = folder['id']
+        return self.folder_id
+
+    def upload(self, path, name):
+        from googleapiclient.http import MediaFileUpload
+        service = self._service()
+        media = MediaFileUpload(path, mimetype='application/zip',
+                                chunksize=self.chunk_size, resumable=True)
+        req = service.files().insert(
+            body={'title': name, 'parents': [{'id': self._folder_id(service)}]},
+            media_body=media)
+        response = None
+        while response is None:
+            _, response = req.next_chunk(num_retries=3)
+
+    def reset(self):
+        self._local.gauth = None
+        self.folder_id = None
+
+def get_backend(config):
+    global _backend
+    with _lock:
+        if _backend is None:
+            if config['BACKUP_BACKEND'] == 'local':
+                _backend = LocalBackend(config['BACKUP_LOCAL_DIR'])
+            else:
+                _backend = DriveBackend()
+        return _backend
+
+# -------------------- Queue --------------------
+def _claim(backup_id, stale):
+    """Take a row no live process is uploading; False if done or taken."""
+    db, Backup = get_models()
+    claimed = Backup.query.filter(
+        Backup.id == backup_id,
+        db.or_(Backup.claimed_at.is_(None), Backup.claimed_at < stale)).update(
+        {'claimed_at': utcnow()}, synchronize_session=False)
+    db.session.commit()
+    return bool(claimed)
+
+def _upload_with_retry(config, backup_id):
+    db, Backup = get_models()
+    if not _claim(backup_id, utcnow() - datetime.timedelta(seconds=config['ORPHAN_GRACE'])):
+        return False
+    row = db.session.get(Backup, backup_id)
+    backend = get_backend(config)
+    retries, base_delay = config['BACKUP_RETRIES'], config['BACKUP_RETRY_DELAY']
+    try:
+        for attempt in range(retries + 1):
+            try:
+                with metrics.span('backup'):
+                    backend.upload(row.path, row.name)
+                log.info('backed up %s', row.name)
+                return True
+            except Exception:
+                log.warning('backup of %s failed (attempt %d/%d)', row.name, attempt + 1,
+                            retries + 1, exc_info=True)
+                backend.reset()
+                if attempt < retries:
+                    time.sleep(base_delay * 2 ** attempt)
+                    row.claimed_at = utcnow()  # still ours
+                    db.session.commit()
+        return False
+    finally:
+        if row.delete_after and os.path.exists(row.path):
+            os.remove(row.path)
+        db.session.delete(row)
+        db.session.commit()
+
+def _run(app, backup_id):
+    try:
+        with app.app_context():
+            return _upload_with_retry(app.config, backup_id)
+    finally:
+        with _lock:
+            _scheduled.discard(backup_id)
+
+def _schedule(app, backup_id):
+    global _executor
+    with _lock:
+        if backup_id in _scheduled:
+            return None
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=app.config['BACKUP_WORKERS'],
+                                           thread_name_prefix='backup')
+        _scheduled.add(backup_id)
+    return _executor.submit(_run, app, backup_id)
+
+def submit(path, name, delete_after=False):
+    """Queue ``path`` for backup as ``name``; returns a Future of success.
+
+    Commits the session: the row must exist before the upload can claim it.
+    """
+    db, Backup = get_models()
+    row = Backup(host=HOST, path=path, name=name, delete_after=delete_after)
+    db.session.add(row)
+    db.session.commit()
+    return _schedule(current_app._get_current_object(), row.id)
+
+def resume():
+    """Queue this host's backups that no process is uploading.
+
+    That is rows left by a restart, and rows claimed longer than
+    ``ORPHAN_GRACE`` ago by a process that died. Another process may have
+    them queued too; only one claims each.
+    """
+    db, Backup = get_models()
+    stale = utcnow() - datetime.timedelta(seconds=current_app.config['ORPHAN_GRACE'])
+    ids = [i for (i,) in db.session.query(Backup.id).filter(
+        Backup.host == HOST, db.or_(Backup.claimed_at.is_(None), Backup.claimed_at < stale))]
+    app = current_app._get_current_object()
+    for backup_id in ids:
+        _schedule(app, backup_id)
+
+def queued_paths():
+    """Normalized paths of this host's files still waiting for (or in) an upload."""
+    db, Backup = get_models()
+    return {os.path.abspath(p) for (p,) in db.session.query(Backup.path).filter(Backup.host == HOST)}
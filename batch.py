@@ -0,0 +1,241 @@
+"""JSON batch API for bulk jobs.
+
+``POST /batch`` takes a manifest and queues it as a single job::
+
+    {"kind": "images",
+     "defaults": {"batch_size": 3, "intensity": 30, "crop": true, "seed": 7},
+     "inputs": [{"path": "nightly/a.jpg"},
+                {"upload": "<sha256>", "name": "b.jpg", "settings": {"batch_size": 5}}]}
+
+An input is either a file on the server, relative to (or inside) one of the
+``BATCH_ROOTS`` directories, or a source stored earlier with
+``POST /batch/uploads``. Per-input ``settings`` override ``defaults`` and
+take the same fields as the processor forms, with booleans for the
+checkboxes. Inputs are hard-linked into the job's spool dir, so nothing is
+copied or sent over HTTP again.
+
+Inputs are only resolved when the manifest is submitted; the worker
+hashes and probes them, fails the variants of any it cannot use and
+charges the job's tokens once it knows the sizes.
+
+``GET /batch/<job_id>/results`` answers right away with NDJSON: one
+``output`` or ``failed`` line per variant finished since ``?after=``, then
+either ``end`` or a ``next`` line carrying the cursor (and ``next_url``) to
+ask with again, after ``retry_after`` seconds.
+"""
+import json
+import os
+import re
+import shutil
+
+from flask import Blueprint, Response, abort, current_app, jsonify, request, url_for
+from flask_login import login_required, current_user
+
+from jobs import (POLL_INTERVAL, enqueue, job_failures, job_outputs, new_job_id, output_name,
+                  spool_dir)
+import metrics
+
+batch_bp = Blueprint('batch', __name__)
+
+SOURCE_FOLDER = os.path.join('storage', 'sources')
+KINDS = ('images', 'videos')
+RESULTS_PAGE = 500  # output lines per /results response
+
+def get_models():
+    from app import db, Job
+    return db, Job
+
+class BadInput(ValueError):
+    pass
+
+# -------------------- Sources --------------------
+def source_dir(user_id, upload_id):
+    return os.path.join(SOURCE_FOLDER, str(user_id), upload_id)
+
+def resolve_upload(user_id, upload_id):
+    """``(path, name)`` of a source the user stored with /batch/uploads."""
+    if not isinstance(upload_id, str) or not re.fullmatch(r'[0-9a-f]{64}', upload_id):
+        raise BadInput('not an upload id')
+    folder = source_dir(user_id, upload_id)
+    try:
+        name = os.listdir(folder)[0]
+    except (FileNotFoundError, IndexError):
+        raise BadInput('unknown or expired upload') from None
+    os.utime(folder)  # used again: restart its retention clock
+    return os.path.join(folder, name), name
+
+def resolve_path(path, roots):
+    """Real path of ``path`` if it is a file inside one of ``roots``."""
+    if not isinstance(path, str) or not path:
+        raise BadInput('path must be a string')
+    for root in roots:
+        full = os.path.realpath(os.path.join(root, path))
+        if os.path.commonpath([root, full]) == root and os.path.isfile(full):
+            return full
+    raise BadInput('not a file under an allowed root')
+
+def unique_name(name, taken):
+    stem, ext = os.path.splitext(name)
+    n = 1
+    while name in taken:
+        n += 1
+        name = f'{stem}_{n}{ext}'
+    taken.add(name)
+    return name
+
+@batch_bp.route('/uploads', methods=['POST'])
+@login_required
+def upload_sources():
+    """Store sources once for use in any number of manifests."""
+    from ingest import claim_upload
+    uploads = request.files.getlist('files')
+    folder = spool_dir(request.spool_id or new_job_id())
+    stored = []
+    try:
+        for upload in uploads:
+            name = os.path.basename(upload.filename or '')
+            if not name:
+                continue
+            digest = claim_upload(upload, folder, name)
+            dest = source_dir(current_user.id, digest)
+            if os.path.isdir(dest):
+                os.utime(dest)  # same bytes already stored; keep that copy
+                name = os.listdir(dest)[0]
+            else:
+                os.makedirs(dest)
+                os.replace(os.path.join(folder, name), os.path.join(dest, name))
+            stored.append({'upload': digest, 'name': name,
+                           'size': os.path.getsize(os.path.join(dest, name))})
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    if not stored:
+        return jsonify({'error': 'No files uploaded.'}), 400
+    return jsonify({'uploads': stored}), 201
+
+# -------------------- Submit --------------------
+def parse_manifest(manifest):
+    """Validate a manifest's shape; returns ``(kind, defaults, inputs)``."""
+    if not isinstance(manifest, dict):
+        raise BadInput('body must be a JSON object')
+    kind = manifest.get('kind')
+    if kind not in KINDS:
+        raise BadInput(f"kind must be one of {', '.join(KINDS)}")
+    defaults = manifest.get('defaults') or {}
+    inputs = manifest.get('inputs')
+    if not isinstance(defaults, dict):
+        raise BadInput('defaults must be an object')
+    if not isinstance(inputs, list) or not inputs:
+        raise BadInput('inputs must be a non-empty list')
+    limit = current_app.config['BATCH_MAX_FILES']
+    if len(inputs) > limit:
+        raise BadInput(f'at most {limit} inputs per manifest')
+    return kind, defaults, inputs
+
+@batch_bp.route('', methods=['POST'])
+@login_required
+def submit_batch():
+    """Queue a manifest; inputs are hashed and probed by the worker, not here."""
+    import admission
+    from processing import parse_json_options, parse_seed
+    try:
+        kind, defaults, inputs = parse_manifest(request.get_json(silent=True))
+        # one seed for the whole manifest unless an input picks its own
+        defaults = {'seed': parse_seed(defaults.get('seed')), **defaults}
+        opts = parse_json_options(defaults)
+    except (BadInput, TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    roots = current_app.config['BATCH_ROOTS']
+    filenames, sources, checksums, file_opts, errors = [], {}, {}, {}, []
+    taken = set()
+    for n, item in enumerate(inputs):
+        try:
+            if not isinstance(item, dict):
+                raise BadInput('input must be an object')
+            settings = item.get('settings') or {}
+            if not isinstance(settings, dict):
+                raise BadInput('settings must be an object')
+            fopts = parse_json_options({**defaults, **settings}) if settings else opts
+            if 'upload' in item:
+                src, name = resolve_upload(current_user.id, item['upload'])
+            else:
+                src = resolve_path(item.get('path'), roots)
+                name = os.path.basename(src)
+            name = os.path.basename(item.get('name') or name)
+            if name in ('', '.', '..'):
+                raise BadInput('name must be a file name')
+        except (BadInput, TypeError, ValueError) as e:
+            errors.append({'input': n, 'error': str(e)})
+            continue
+        name = unique_name(name, taken)
+        filenames.append(name)
+        sources[name] = src
+        if 'upload' in item:
+            checksums[name] = item['upload']
+        if fopts != opts:
+            file_opts[name] = fopts
+    if errors:
+        return jsonify({'error': f'{len(errors)} of {len(inputs)} inputs are invalid',
+                        'errors': errors}), 400
+    metrics.inc('bytes_in_total', sum(os.path.getsize(src) for src in sources.values()), kind=kind)
+    try:
+        admission.admit(current_user, kind, None, opts, file_opts)
+    except admission.Rejected as e:
+        return jsonify({'error': str(e), **e.extra}), e.status
+    job_id = new_job_id()
+    job = enqueue(job_id, kind, current_user.id, opts, filenames, checksums, file_opts=file_opts,
+                  sources=sources)
+    return jsonify({
+        'job_id': job_id,
+        'files': len(filenames),
+        'variants_total': json.loads(job.progress)['variants_total'],
+        'status_url': url_for('jobs.job_status', job_id=job_id),
+        'results_url': url_for('batch.batch_results', job_id=job_id),
+    }), 202
+
+# -------------------- Results --------------------
+@batch_bp.route('/<job_id>/results')
+@login_required
+def batch_results(job_id):
+    """Results after ``?after=<cursor>``, returned at once instead of held open."""
+    db, Job = get_models()
+    job = db.session.get(Job, job_id)
+    if job is None or job.user_id != current_user.id:
+        abort(404)
+    try:
+        after, failed = (int(n) for n in request.args.get('after', '0.0').split('.'))
+    except ValueError:
+        return jsonify({'error': 'after must be a cursor from a previous response'}), 400
+
+    def line(**data):
+        return json.dumps(data) + '\n'
+
+    # read the status before the outputs: a finished job's rows are committed
+    # before its status, so none can be missed
+    status, error, data = job.status, job.error, json.loads(job.progress)
+    rows = job_outputs(job_id, after, RESULTS_PAGE)
+    out = [line(event='output', input=row.source, name=output_name(row), sha256=row.sha256,
+                url=url_for('download_file', filename=row.filename)) for row in rows]
+    if rows:
+        after = rows[-1].id
+    fails = job_failures(job_id, failed, RESULTS_PAGE)
+    out += [line(event='failed', input=fail.file, variant=fail.variant, error=fail.error)
+            for fail in fails]
+    if fails:
+        failed = fails[-1].id
+    counts = {'variants_total': data['variants_total'], 'variants_done': data['variants_done'],
+              'variants_failed': data['variants_failed']}
+    full = len(rows) == RESULTS_PAGE or len(fails) == RESULTS_PAGE
+    if status in ('done', 'failed') and not full:
+        end = {'status': status, 'error': error, **counts}
+        if job.zip_filename:
+            end['download_url'] = url_for('download_zip', filename=job.zip_filename)
+        elif status == 'done':
+            end['download_url'] = url_for('jobs.job_download', job_id=job_id)
+        out.append(line(event='end', **end))
+    else:
+        cursor = f'{after}.{failed}'
+        out.append(line(event='next', status=status, after=cursor, **counts,
+                        next_url=url_for('batch.batch_results', job_id=job_id, after=cursor),
+                        retry_after=0 if full else POLL_INTERVAL))
+    return Response(out, mimetype='application/x-ndjson', headers={'Cache-Control': 'no-cache'})
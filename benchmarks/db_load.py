@@ -0,0 +1,129 @@
+"""Load test for concurrent token credits.
+
+    python benchmarks/db_load.py --workers 8 --requests 50
+    DATABASE_URL=postgresql://... python benchmarks/db_load.py
+
+Spawns ``--workers`` processes (as gunicorn would), each importing the app
+and sending ``--requests`` signed ``invoice.payment_succeeded`` webhooks for
+the same subscription plus ``--referrals`` registrations using one referral
+code. Every credit must land: the report compares the final token balance
+with the expected one and counts failed requests (e.g. "database is locked").
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET = 'whsec_loadtest'
+SUBSCRIPTION = 'sub_loadtest'
+REFERRAL_CODE = 'LOADTEST'
+
+def setup_env(workdir, url):
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    os.environ.update({'DATABASE_URL': url, 'STRIPE_WEBHOOK_SECRET': SECRET,
+                       'JOB_WORKERS_EMBEDDED': '0', 'RETENTION_EMBEDDED': '0'})
+
+def signed(payload):
+    t = str(int(time.time()))
+    sig = hmac.new(SECRET.encode(), f'{t}.{payload}'.encode(), hashlib.sha256).hexdigest()
+    return {'Stripe-Signature': f't={t},v1={sig}', 'Content-Type': 'application/json'}
+
+def _worker(n, args, workdir, url, start, out):
+    setup_env(workdir, url)
+    from app import app
+    client = app.test_client()
+    errors, latencies = 0, []
+    start.wait()
+    for i in range(max(args.requests, args.referrals)):
+        calls = []
+        if i < args.requests:
+            payload = json.dumps({'id': f'evt_{n}_{i}', 'object': 'event',
+                                  'type': 'invoice.payment_succeeded',
+                                  'data': {'object': {'subscription': SUBSCRIPTION}}})
+            calls.append(lambda: client.post('/subscription/webhook', data=payload,
+                                             headers=signed(payload)))
+        if i < args.referrals:
+            def register(i=i):
+                with client.session_transaction() as sess:
+                    sess['referral_code'] = REFERRAL_CODE
+                return client.post('/register', data={'email': f'u{n}_{i}@load.test', 'password': 'x'})
+            calls.append(register)
+        for call in calls:
+            t0 = time.perf_counter()
+            try:
+                status = call().status_code
+            except Exception:
+                status = 500
+            latencies.append(time.perf_counter() - t0)
+            errors += status >= 400
+    out.put({'errors': errors, 'latencies': latencies})
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=50, help='webhooks per worker')
+    parser.add_argument('--referrals', type=int, default=10, help='registrations per worker')
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp(prefix='db-load-')
+    url = os.getenv('DATABASE_URL') or f"sqlite:///{os.path.join(workdir, 'load.db')}"
+    cwd = os.getcwd()
+    setup_env(workdir, url)
+    from app import app, db, User
+    with app.app_context():
+        db.create_all()
+        user = User(email='payer@load.test', password='x', referral_code=REFERRAL_CODE,
+                    stripe_subscription_id=SUBSCRIPTION, tokens=0)
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+        db.engine.dispose()  # children open their own connections
+
+    ctx = multiprocessing.get_context('spawn')
+    start, out = ctx.Event(), ctx.Queue()
+    procs = [ctx.Process(target=_worker, args=(n, args, workdir, url, start, out))
+             for n in range(args.workers)]
+    for p in procs:
+        p.start()
+    time.sleep(2)  # let every worker import the app before the burst
+    t0 = time.perf_counter()
+    start.set()
+    results = [out.get() for _ in procs]
+    elapsed = time.perf_counter() - t0
+    for p in procs:
+        p.join()
+
+    with app.app_context():
+        tokens = db.session.get(User, user_id).tokens
+        if url.startswith('postgres') or 'mysql' in url:
+            # leave a server database as we found it
+            User.query.filter(User.email.like('%@load.test')).delete(synchronize_session=False)
+            db.session.commit()
+    latencies = sorted(l for r in results for l in r['latencies'])
+    expected = args.workers * (args.requests * 100 + args.referrals * 10)
+    report = {
+        'database': url.split(':', 1)[0],
+        'workers': args.workers,
+        'requests': len(latencies),
+        'errors': sum(r['errors'] for r in results),
+        'expected_tokens': expected,
+        'actual_tokens': tokens,
+        'missing_tokens': expected - tokens,
+        'seconds': round(elapsed, 3),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+        'p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 2),
+    }
+    print(json.dumps(report, indent=2))
+    os.chdir(cwd)
+    shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(0 if tokens == expected and not report['errors'] else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""Benchmark the image and video variant pipelines on synthetic inputs.
+
+    python benchmarks/pipelines.py run --out bench.json
+    python benchmarks/pipelines.py run --kind images --sizes 1920x1080 --batch-sizes 10
+    python benchmarks/pipelines.py compare base.json bench.json
+
+Inputs are generated locally: gradient/noise JPEGs at each size and short
+clips from ffmpeg's ``testsrc`` (with a sine audio track). Every case runs
+in a fresh process and reports throughput, p50/p95 per-variant latency
+(from submission, when every variant of the case is handed to the renderer,
+to that variant's completion), p50/p95 interval between consecutive
+completions, peak RSS of the process and its children, and bytes written.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TRANSFORMS = ('adjust_contrast', 'adjust_brightness', 'rotate', 'crop', 'flip_horizontal')
+
+# -------------------- Inputs --------------------
+def make_image(path, size):
+    from PIL import Image
+    w, h = size
+    img = Image.linear_gradient('L').resize((w, h)).convert('RGB')
+    noise = Image.effect_noise((w, h), 40).convert('RGB')
+    Image.blend(img, noise, 0.3).save(path, quality=90)
+
+def make_video(path, size, seconds):
+    w, h = size
+    subprocess.run(['ffmpeg', '-v', 'error', '-y',
+                    '-f', 'lavfi', '-i', f'testsrc=size={w}x{h}:rate=30',
+                    '-f', 'lavfi', '-i', 'sine=frequency=440',
+                    '-t', str(seconds), '-pix_fmt', 'yuv420p',
+                    '-c:v', 'libx264', '-preset', 'ultrafast', '-c:a', 'aac', '-shortest', path],
+                   check=True)
+
+def combos(all_combos):
+    if all_combos:
+        return [c for n in range(len(TRANSFORMS) + 1) for c in itertools.combinations(TRANSFORMS, n)]
+    return [(t,) for t in TRANSFORMS] + [TRANSFORMS]
+
+# -------------------- Cases --------------------
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+def _run_case(case, config, out):
+    from flask import Flask
+    import processing
+    workdir = tempfile.mkdtemp(prefix='bench-out-')
+    app = Flask('bench')
+    app.config.update(config)
+    opts = {'batch_size': case['batch_size'], 'intensity': case['intensity'],
+            'encode_profile': config.get('ENCODE_PROFILE', 'medium')}
+    opts.update({t: t in case['transforms'] for t in TRANSFORMS})
+    done = []
+    written = []
+    failures = []
+
+    def on_variant(filename, index, error=None, path=None):
+        done.append(time.perf_counter())
+        if path:
+            written.append(os.path.getsize(path))
+
+    render = processing.render_images if case['kind'] == 'images' else processing.render_videos
+    with app.app_context():
+        t0 = time.perf_counter()
+        failures = render([(case['source'], os.path.basename(case['source']))], workdir, opts, on_variant)
+        elapsed = time.perf_counter() - t0
+    latencies = [(t - t0) * 1000 for t in done]
+    intervals = [(b - a) * 1000 for a, b in zip([t0] + done[:-1], done)]
+    shutil.rmtree(workdir, ignore_errors=True)
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    out.put({
+        'variants': len(written),
+        'failures': len(failures),
+        'seconds': round(elapsed, 4),
+        'variants_per_second': round(len(written) / elapsed, 3) if elapsed else None,
+        'latency_p50_ms': round(percentile(latencies, 50), 2) if latencies else None,
+        'latency_p95_ms': round(percentile(latencies, 95), 2) if latencies else None,
+        'interval_p50_ms': round(percentile(intervals, 50), 2) if intervals else None,
+        'interval_p95_ms': round(percentile(intervals, 95), 2) if intervals else None,
+        'peak_rss_kib': self_rss,
+        'peak_child_rss_kib': child_rss,
+        'bytes_written': sum(written),
+    })
+
+def run_case(case, config):
+    ctx = multiprocessing.get_context('spawn')
+    out = ctx.Queue()
+    proc = ctx.Process(target=_run_case, args=(case, config, out))
+    proc.start()
+    result = out.get()
+    proc.join()
+    return result
+
+def case_key(case):
+    return (f"{case['kind']}:{case['size']}:b{case['batch_size']}:i{case['intensity']}:"
+            f"{'+'.join(t.replace('adjust_', '') for t in case['transforms']) or 'none'}")
+
+def run(args):
+    inputs = tempfile.mkdtemp(prefix='bench-in-')
+    config = {
+        'IMAGE_WORKERS': args.workers,
+        'IMAGE_PIPELINE': args.image_pipeline,
+        'FFMPEG_MAX_PROCS': args.workers,
+        'VIDEO_RENDER_MODE': args.video_mode,
+        'ENCODE_PROFILE': args.encode_profile,
+    }
+    results = []
+    try:
+        for kind in args.kind:
+            for size_s in (args.sizes or (['640x480', '1920x1080', '4000x3000'] if kind == 'images'
+                                          else ['640x360', '1280x720'])):
+                size = tuple(int(v) for v in size_s.split('x'))
+                if kind == 'images':
+                    source = os.path.join(inputs, f'src_{size_s}.jpg')
+                    make_image(source, size)
+                else:
+                    source = os.path.join(inputs, f'src_{size_s}.mp4')
+                    make_video(source, size, args.seconds)
+                for batch_size, intensity, transforms in itertools.product(
+                        args.batch_sizes, args.intensities, combos(args.all_combos)):
+                    case = {'kind': kind, 'size': size_s, 'source': source, 'batch_size': batch_size,
+                            'intensity': intensity, 'transforms': list(transforms)}
+                    result = run_case(case, config)
+                    key = case_key(case)
+                    results.append({'case': key, **result})
+                    print(f"{key:60s} {result['variants_per_second']:>9} var/s  "
+                          f"latency p50 {result['latency_p50_ms']}ms  p95 {result['latency_p95_ms']}ms",
+                          file=sys.stderr)
+    finally:
+        shutil.rmtree(inputs, ignore_errors=True)
+    report = {
+        'meta': {'python': platform.python_version(), 'machine': platform.machine(),
+                 'cpus': os.cpu_count(), 'config': config, 'created': time.time()},
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+def compare(args):
+    with open(args.base) as f:
+        base = {r['case']: r for r in json.load(f)['results']}
+    with open(args.new) as f:
+        new = {r['case']: r for r in json.load(f)['results']}
+    print(f"{'case':60s} {'var/s':>18} {'latency p95 ms':>18} {'rss KiB':>20}")
+    for key in sorted(base.keys() & new.keys()):
+        b, n = base[key], new[key]
+        def delta(field):
+            # reports from before a field existed lack it
+            if not b.get(field) or n.get(field) is None:
+                return f"{n.get(field)}"
+            return f"{n[field]} ({(n[field] - b[field]) / b[field] * 100:+.0f}%)"
+        print(f"{key:60s} {delta('variants_per_second'):>18} {delta('latency_p95_ms'):>18} "
+              f"{delta('peak_rss_kib'):>20}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+    r = sub.add_parser('run')
+    r.add_argument('--kind', nargs='+', choices=('images', 'videos'), default=['images', 'videos'])
+    r.add_argument('--sizes', nargs='+', help='WxH; defaults depend on kind')
+    r.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 5])
+    r.add_argument('--intensities', nargs='+', type=int, default=[30, 100])
+    r.add_argument('--all-combos', action='store_true', help='all 32 transform subsets')
+    r.add_argument('--seconds', type=float, default=2, help='length of test videos')
+    r.add_argument('--workers', type=int, default=1, help='image workers / ffmpeg processes')
+    r.add_argument('--image-pipeline', choices=('fused', 'chained'), default='fused')
+    r.add_argument('--video-mode', choices=('auto', 'split', 'per_variant', 'segmented'), default='per_variant')
+    r.add_argument('--encode-profile', default='medium')
+    r.add_argument('--out')
+    c = sub.add_parser('compare')
+    c.add_argument('base')
+    c.add_argument('new')
+    args = parser.parse_args()
+    run(args) if args.command == 'run' else compare(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""Startup time and worker memory of the web app.
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --workers 4 --max-import-ms 600 --max-rss-mb 80
+
+Every measurement runs in a fresh interpreter inside a scratch directory:
+
+* ``import``: wall time of ``import app``, RSS afterwards and which heavy
+  libraries (PIL, ffmpeg, stripe, pydrive, alembic) it pulled in;
+* ``first_request``: RSS after serving the login page;
+* ``media``: RSS once a job worker has loaded the image engine and ffmpeg;
+* ``workers``: unique (USS) and proportional (PSS) memory per forked worker
+  after serving a few pages, with the app preloaded in the parent (as
+  ``gunicorn.conf.py`` does) and imported after the fork.
+
+Exits non-zero when a ``--max-*`` limit is exceeded or a library listed in
+``--forbid`` is imported at startup, so CI can catch regressions.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ('PIL', 'ffmpeg', 'stripe', 'pydrive', 'alembic')
+
+PROBE = r'''
+import json, os, sys, time
+sys.path.insert(0, os.environ['APP_ROOT'])
+
+def rss_kib():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+t0 = time.perf_counter()
+import app
+out = {'import_ms': (time.perf_counter() - t0) * 1000, 'import_rss_kib': rss_kib(),
+       'heavy': [m for m in HEAVY if m in sys.modules]}
+app.app.test_client().get('/login')
+out['first_request_rss_kib'] = rss_kib()
+with app.app.app_context():
+    import ffmpeg, image_engine
+out['media_rss_kib'] = rss_kib()
+print(json.dumps(out))
+'''
+
+WORKERS = r'''
+import gc, json, os, sys
+sys.path.insert(0, os.environ['APP_ROOT'])
+preload, workers, requests = sys.argv[1] == '1', int(sys.argv[2]), int(sys.argv[3])
+
+def smaps():
+    mem = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            key, _, rest = line.partition(':')
+            if rest.strip().endswith('kB'):
+                mem[key] = int(rest.split()[0])
+    return {'uss_kib': mem['Private_Clean'] + mem['Private_Dirty'], 'pss_kib': mem['Pss']}
+
+if preload:
+    gc.disable()
+    import app
+    gc.freeze()
+pipes = []
+for _ in range(workers):
+    r, w = os.pipe()
+    if os.fork() == 0:
+        os.close(r)
+        gc.enable()
+        import app
+        client = app.app.test_client()
+        for _ in range(requests):
+            client.get('/login')
+        os.write(w, json.dumps(smaps()).encode())
+        os._exit(0)
+    os.close(w)
+    pipes.append(r)
+# all children are alive until they have written, so PSS splits shared pages fairly
+results = [json.loads(os.read(r, 4096)) for r in pipes]
+for _ in pipes:
+    os.wait()
+print(json.dumps(results))
+'''
+
+def env_for(workdir):
+    return dict(os.environ, APP_ROOT=ROOT, DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'startup.db')}",
+                JOB_WORKERS_EMBEDDED='0', RETENTION_EMBEDDED='0')
+
+def run_python(code, workdir, *args):
+    code = f'HEAVY = {HEAVY!r}\n' + code
+    proc = subprocess.run([sys.executable, '-c', code, *map(str, args)], cwd=workdir,
+                          env=env_for(workdir), capture_output=True, text=True, check=True)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def mib(kib):
+    return round(kib / 1024, 1)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters for the import timing')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=20, help='pages served per worker')
+    parser.add_argument('--max-import-ms', type=float)
+    parser.add_argument('--max-rss-mb', type=float, help='limit on RSS after import')
+    parser.add_argument('--max-worker-uss-mb', type=float, help='limit on preloaded worker USS')
+    parser.add_argument('--forbid', default='PIL,ffmpeg,stripe,pydrive,alembic',
+                        help='libraries that must not load at startup ("" to allow all)')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='startup-')
+    try:
+        runs = [run_python(PROBE, workdir) for _ in range(args.repeat)]
+        report = {
+            'import_ms': round(statistics.median(r['import_ms'] for r in runs), 1),
+            'import_rss_mb': mib(statistics.median(r['import_rss_kib'] for r in runs)),
+            'first_request_rss_mb': mib(statistics.median(r['first_request_rss_kib'] for r in runs)),
+            'media_rss_mb': mib(statistics.median(r['media_rss_kib'] for r in runs)),
+            'heavy_at_import': runs[0]['heavy'],
+            'workers': {},
+        }
+        if os.path.exists('/proc/self/smaps_rollup') and hasattr(os, 'fork'):
+            for mode, preload in (('preload', 1), ('import_after_fork', 0)):
+                procs = run_python(WORKERS, workdir, preload, args.workers, args.requests)
+                report['workers'][mode] = {
+                    'uss_mb': mib(statistics.mean(p['uss_kib'] for p in procs)),
+                    'pss_mb': mib(statistics.mean(p['pss_kib'] for p in procs)),
+                }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(json.dumps(report, indent=2))
+
+    problems = []
+    forbidden = [m for m in report['heavy_at_import'] if m in args.forbid.split(',')]
+    if forbidden:
+        problems.append(f"imported at startup: {', '.join(forbidden)}")
+    if args.max_import_ms and report['import_ms'] > args.max_import_ms:
+        problems.append(f"import took {report['import_ms']} ms > {args.max_import_ms}")
+    if args.max_rss_mb and report['import_rss_mb'] > args.max_rss_mb:
+        problems.append(f"RSS after import {report['import_rss_mb']} MB > {args.max_rss_mb}")
+    preloaded = report['workers'].get('preload')
+    if args.max_worker_uss_mb and preloaded and preloaded['uss_mb'] > args.max_worker_uss_mb:
+        problems.append(f"preloaded worker USS {preloaded['uss_mb']} MB > {args.max_worker_uss_mb}")
+    for p in problems:
+        print(f'REGRESSION: {p}', file=sys.stderr)
+    sys.exit(1 if problems else 0)
+
+if __name__ == '__main__':
+    main()
@@ -4,12 +4,9 @@ import os
 # Load environment variables
 load_dotenv()
 
-import stripe
 from flask import Blueprint, request, jsonify, url_for
 from flask_login import login_required, current_user
 
-stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
-
 subscription_bp = Blueprint('subscription', __name__)
 referral_bp     = Blueprint('referral', __name__)
 
@@ -17,10 +14,17 @@ def get_models():
     from app import db, User
     return db, User
 
+def get_stripe():
+    # imported on first use: most workers never talk to Stripe
+    import stripe
+    stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
+    return stripe
+
 @subscription_bp.route('/create-checkout-session', methods=['POST'])
 @login_required
 def create_checkout():
     db, User = get_models()
+    stripe = get_stripe()
     data = request.get_json() or {}
     plan_id = data.get('plan')
     if not current_user.stripe_customer_id:
@@ -40,6 +44,7 @@ def create_checkout():
 @subscription_bp.route('/webhook', methods=['POST'])
 def webhook_received():
     db, User = get_models()
+    stripe = get_stripe()
     payload = request.data
     sig = request.headers.get('stripe-signature')
     try:
@@ -48,10 +53,10 @@ def webhook_received():
         return jsonify({'error': str(e)}), 400
     if event['type'] == 'invoice.payment_succeeded':
         inv = event['data']['object']
-        user = User.query.filter_by(stripe_subscription_id=inv['subscription']).first()
-        if user:
-            user.tokens += 100
-            db.session.commit()
+        # SQL-side increment so concurrent webhooks never lose a credit
+        User.query.filter_by(stripe_subscription_id=inv['subscription']).update(
+            {User.tokens: User.tokens + 100}, synchronize_session=False)
+        db.session.commit()
     if event['type'] == 'customer.subscription.created':
         sub = event['data']['object']
         user = User.query.filter_by(stripe_customer_id=sub['customer']).first()
@@ -0,0 +1,36 @@
+"""Database engine settings.
+
+``DATABASE_URL`` selects the database (default: SQLite in the instance
+folder). Server databases get a bounded connection pool that is pinged
+before use and recycled periodically. SQLite connections run in WAL mode
+with a busy timeout, so concurrent gunicorn workers and job threads wait
+for the write lock instead of failing with "database is locked".
+"""
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+def database_url(url):
+    url = url or 'sqlite:///users.db'
+    if url.startswith('postgres://'):  # Heroku-style URLs
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+def engine_options(url, pool_size=5, max_overflow=10, pool_timeout=30, pool_recycle=1800,
+                   busy_timeout=15):
+    if url.startswith('sqlite'):
+        # pysqlite's timeout is SQLite's busy timeout, in seconds
+        return {'connect_args': {'timeout': busy_timeout}}
+    return {'pool_size': pool_size, 'max_overflow': max_overflow, 'pool_timeout': pool_timeout,
+            'pool_recycle': pool_recycle, 'pool_pre_ping': True}
+
+@event.listens_for(Engine, 'connect')
+def _sqlite_pragmas(dbapi_conn, _):
+    if not isinstance(dbapi_conn, sqlite3.Connection):
+        return
+    cur = dbapi_conn.cursor()
+    # readers no longer block the writer; NORMAL is durable enough under WAL
+    cur.execute('PRAGMA journal_mode=WAL')
+    cur.execute('PRAGMA synchronous=NORMAL')
+    cur.close()
@@ -0,0 +1,46 @@
+"""Gunicorn settings, picked up by ``gunicorn app:app`` from this directory.
+
+The app is imported once in the master (``GUNICORN_PRELOAD``, default on)
+and workers are forked from it, so they share its code and import-time
+objects copy-on-write instead of each importing them again. Python's
+garbage collector would touch every shared object and unshare its page, so
+the master freezes everything it allocated before the first fork.
+
+Media libraries load lazily; set ``PRELOAD_MEDIA=1`` to import PIL and
+ffmpeg in the master too when web workers also run embedded job workers.
+Workers that only serve pages then still share those pages for free.
+
+With ``METRICS_DIR`` set, workers share their metrics through that
+directory (see metrics.py); it is emptied when the server starts.
+"""
+import gc
+import os
+import shutil
+
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+
+if preload_app:
+    gc.disable()  # no collections (and freed holes in shared pages) until the fork
+
+def on_starting(server):
+    if os.getenv('METRICS_DIR'):
+        # totals restart with the server, like any per-process counter would
+        shutil.rmtree(os.getenv('METRICS_DIR'), ignore_errors=True)
+
+def when_ready(server):
+    if not preload_app:
+        return
+    if os.getenv('PRELOAD_MEDIA', '0') == '1':
+        import ffmpeg  # noqa: F401
+        import image_engine  # noqa: F401  (PIL)
+    gc.freeze()
+    gc.enable()
+
+def post_fork(server, worker):
+    if not preload_app:
+        return
+    gc.enable()
+    # pooled connections must never be shared between processes
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
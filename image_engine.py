@@ -0,0 +1,417 @@
+"""Process-pool image variant engine.
+
+The parent decodes each source once, writes its raw pixels to a temp file
+(on /dev/shm when available) and draws every variant's random parameters
+up front. Workers mmap the raw file, apply the transforms and encode the
+JPEG, so only file paths and a few floats cross the process boundary.
+
+Two transform pipelines are available. ``chained`` is the original
+copy/enhance/rotate/crop/transpose sequence. ``fused`` folds contrast and
+brightness into one lookup table and rotate, crop and flip into one affine
+resample, so each variant allocates two full-size buffers instead of up to
+six. ``python image_engine.py compare <image>`` reports the difference;
+``check <image>`` verifies that both produce the same pixels.
+"""
+import errno
+import json
+import math
+import mmap
+import multiprocessing
+import os
+import random
+import resource
+import struct
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image, ImageEnhance, ImageStat
+
+import metrics
+from processing import (options_for, scale_range, source_sha256, variant_name, variant_rng,
+                        wanted_indices)
+
+RAW_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+_pool = None
+_pool_lock = threading.Lock()
+_sources = OrderedDict()  # worker-side cache: raw path -> {'img', 'mean'}
+
+PIPELINES = ('fused', 'chained')
+FUSED_MODES = ('L', 'RGB', 'RGBA')
+
+# -------------------- Variant Parameters --------------------
+def draw_params(opts, rng=random):
+    """Draw one variant's parameters in the same order the inline path did."""
+    intensity = opts['intensity']
+    p = {}
+    if opts['adjust_contrast']:
+        p['contrast'] = 1 + scale_range(-0.1,0.1,intensity,rng)
+    if opts['adjust_brightness']:
+        p['brightness'] = 1 + scale_range(-0.1,0.1,intensity,rng)
+    if opts['rotate']:
+        p['angle'] = scale_range(-5,5,intensity,rng)
+    if opts['crop']:
+        p['crop'] = (scale_range(0.01,0.05,intensity,rng), scale_range(0.01,0.05,intensity,rng))
+    if opts['flip_horizontal']:
+        p['flip'] = rng.random() > 0.5
+    return p
+
+def apply_params(img, p):
+    var = img.copy()
+    if 'contrast' in p:
+        var = ImageEnhance.Contrast(var).enhance(p['contrast'])
+    if 'brightness' in p:
+        var = ImageEnhance.Brightness(var).enhance(p['brightness'])
+    if 'angle' in p:
+        var = var.rotate(p['angle'], expand=True)
+    if 'crop' in p:
+        w,h = var.size
+        dx,dy = int(w*p['crop'][0]), int(h*p['crop'][1])
+        var = var.crop((dx,dy,w-dx,h-dy))
+    if p.get('flip'):
+        var = var.transpose(Image.FLIP_LEFT_RIGHT)
+    return var
+
+# -------------------- Fused Pipeline --------------------
+def _f32(x):
+    return struct.unpack('f', struct.pack('f', x))[0]
+
+def _blend_lut(base, alpha):
+    """Table equal to Image.blend(constant ``base``, image, alpha) per value."""
+    # ImagingBlend works in C floats and truncates; mirror that exactly
+    a = _f32(alpha)
+    lut = []
+    for x in range(256):
+        v = _f32(base + _f32(a * (x - base)))
+        lut.append(0 if v <= 0 else 255 if v >= 255 else int(v))
+    return lut
+
+def grey_mean(img):
+    """The mean ImageEnhance.Contrast blends towards."""
+    grey = img if img.mode == 'L' else img.convert('L')
+    return int(ImageStat.Stat(grey).mean[0] + 0.5)
+
+def tone_table(img, p, mean):
+    lut = list(range(256))
+    if 'contrast' in p:
+        c = _blend_lut(mean, p['contrast'])
+        lut = [c[v] for v in lut]
+    if 'brightness' in p:
+        b = _blend_lut(0, p['brightness'])
+        lut = [b[v] for v in lut]
+    if img.mode == 'RGBA':
+        return lut * 3 + list(range(256))
+    return lut * len(img.getbands())
+
+def rotate_matrix(w, h, angle):
+    """Inverse matrix and size of ``rotate(angle, expand=True)`` as Pillow builds them."""
+    angle = -math.radians(angle % 360.0)
+    a, b = round(math.cos(angle), 15), round(math.sin(angle), 15)
+    d, e = round(-math.sin(angle), 15), round(math.cos(angle), 15)
+    cx, cy = w / 2, h / 2
+    c = a * -cx + b * -cy + cx
+    f = d * -cx + e * -cy + cy
+    xx = [a * x + b * y + c for x, y in ((0, 0), (w, 0), (w, h), (0, h))]
+    yy = [d * x + e * y + f for x, y in ((0, 0), (w, 0), (w, h), (0, h))]
+    nw = math.ceil(max(xx)) - math.floor(min(xx))
+    nh = math.ceil(max(yy)) - math.floor(min(yy))
+    ox, oy = -(nw - w) / 2.0, -(nh - h) / 2.0
+    return [a, b, a * ox + b * oy + c, d, e, d * ox + e * oy + f], (nw, nh)
+
+def _fix(v):
+    """``v`` in the 16.16 fixed point Pillow's nearest affine resample steps in."""
+    return math.floor(v * 65536.0 + 0.5)
+
+def fused_geometry(size, p):
+    """One affine matrix (output -> source) for rotate, crop and flip.
+
+    Pillow samples a rotation at ``x * FIX(a) + FIX(c + a/2 + b/2)``, so
+    shifting the float matrix for crop and flip would round differently
+    from cropping and flipping the rotated image and move ~2% of the pixels
+    by one. With a rotation the matrix is therefore composed from those
+    fixed-point terms, which Pillow then reproduces exactly.
+    """
+    if 'angle' not in p or not p['angle'] % 360:
+        (a, b, c, d, e, f), (w, h) = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0), size
+        if 'crop' in p:
+            dx, dy = int(w*p['crop'][0]), int(h*p['crop'][1])
+            c, f = c + dx, f + dy
+            w, h = w - 2*dx, h - 2*dy
+        if p.get('flip'):
+            a, c = -a, c + w
+        return (a, b, c, d, e, f), (w, h)
+    (a, b, c, d, e, f), (w, h) = rotate_matrix(*size, p['angle'])
+    a0, a1, a3, a4 = _fix(a), _fix(b), _fix(d), _fix(e)
+    a2, a5 = _fix(c + a * 0.5 + b * 0.5), _fix(f + d * 0.5 + e * 0.5)
+    dx = dy = 0
+    if 'crop' in p:
+        dx, dy = int(w*p['crop'][0]), int(h*p['crop'][1])
+        w, h = w - 2*dx, h - 2*dy
+    # output column 0 is rotated column dx, or w-1+dx when flipped
+    x0 = dx + (w - 1 if p.get('flip') else 0)
+    a2, a5 = a2 + x0*a0 + dy*a1, a5 + x0*a3 + dy*a4
+    if p.get('flip'):
+        a0, a3 = -a0, -a3
+    # exact in binary, so Pillow's FIX() gives back the same integers
+    a, b, d, e = a0 / 65536, a1 / 65536, a3 / 65536, a4 / 65536
+    return (a, b, a2 / 65536 - a * 0.5 - b * 0.5, d, e, a5 / 65536 - d * 0.5 - e * 0.5), (w, h)
+
+def apply_params_fused(img, p, mean=None):
+    if img.mode not in FUSED_MODES:
+        return apply_params(img, p)
+    var = img
+    if 'contrast' in p or 'brightness' in p:
+        if mean is None and 'contrast' in p:
+            mean = grey_mean(img)
+        var = var.point(tone_table(img, p, mean))
+    if 'angle' in p or 'crop' in p or p.get('flip'):
+        matrix, size = fused_geometry(var.size, p)
+        var = var.transform(size, Image.AFFINE, matrix, Image.NEAREST)
+    return var
+
+# -------------------- Shared Source --------------------
+def share_source(img):
+    """Dump decoded pixels to a raw temp file; returns its descriptor.
+
+    When /dev/shm is full the file goes to the regular temp dir instead;
+    a partly written file is always removed.
+    """
+    img.load()
+    data = img.tobytes()
+    folders = [RAW_DIR, None] if RAW_DIR else [None]
+    for n, folder in enumerate(folders, 1):
+        fd, path = tempfile.mkstemp(prefix='imgsrc-', suffix='.raw', dir=folder)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            break
+        except OSError as e:
+            os.remove(path)
+            if e.errno not in (errno.ENOSPC, errno.EDQUOT) or n == len(folders):
+                raise
+    return {'path': path, 'mode': img.mode, 'size': img.size,
+            'palette': img.getpalette() if img.mode == 'P' else None}
+
+def open_shared(src):
+    entry = _sources.get(src['path'])
+    if entry is None:
+        # a mapping keeps its tmpfs pages alive after the parent unlinks the file
+        for path in [p for p in _sources if not os.path.exists(p)]:
+            del _sources[path]
+        with open(src['path'], 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        img = Image.frombuffer(src['mode'], tuple(src['size']), buf, 'raw', src['mode'], 0, 1)
+        if src['palette']:
+            img.putpalette(src['palette'])
+        entry = _sources[src['path']] = {'img': img, 'mean': None}
+        while len(_sources) > 2:
+            _sources.popitem(last=False)
+    else:
+        _sources.move_to_end(src['path'])
+    return entry
+
+def render_variant(src, params, dest, pipeline='fused'):
+    """Render one variant; returns its ``{'transform', 'encode'}`` seconds."""
+    t0 = time.perf_counter()
+    entry = open_shared(src)
+    if pipeline == 'fused':
+        if 'contrast' in params and entry['mean'] is None:
+            entry['mean'] = grey_mean(entry['img'])
+        var = apply_params_fused(entry['img'], params, entry['mean'])
+    else:
+        var = apply_params(entry['img'], params)
+    t1 = time.perf_counter()
+    var.save(dest)
+    return {'transform': t1 - t0, 'encode': time.perf_counter() - t1}
+
+def _record(timings):
+    for stage, seconds in timings.items():
+        metrics.observe(stage, seconds)
+
+# -------------------- Pool --------------------
+def get_pool(workers):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # forkserver: forking the threaded web/job process is unsafe
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _pool = ProcessPoolExecutor(max_workers=workers,
+                                        mp_context=multiprocessing.get_context(method))
+        return _pool
+
+def reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+def render(sources, output_folder, opts, on_variant=None, workers=None, pipeline='fused',
+           checksums=None, variants=None, file_opts=None):
+    """Render every ``(path, filename)`` in sources on the process pool.
+
+    ``on_variant(filename, index, error, path)`` is called on the calling
+    thread as variants finish; ``workers=1`` renders inline. Each variant's
+    parameters are drawn from processing.variant_rng(); ``variants`` limits
+    which indices are rendered per file and ``file_opts`` overrides ``opts``
+    per file. Returns a list of
+    ``(filename, index, error)`` for variants that failed.
+
+    At most ``workers`` sources are staged at a time and each raw file is
+    removed as soon as its last variant is done, so /dev/shm use does not
+    grow with the number of files in a job.
+    """
+    workers = workers or os.cpu_count() or 1
+    pool = get_pool(workers) if workers > 1 else None
+    failures = []
+    tasks = {}
+    staged = {}  # raw path -> variants still rendering from it
+
+    def finished(filename, i, error, dest, raw):
+        if error:
+            failures.append((filename, i, error))
+        if on_variant:
+            on_variant(filename, i, error, None if error else dest)
+        staged[raw] -= 1
+        if not staged[raw]:
+            del staged[raw]
+            os.remove(raw)
+
+    def collect():
+        done, _ = wait(tasks, return_when=FIRST_COMPLETED)
+        for fut in done:
+            filename, i, dest, raw = tasks.pop(fut)
+            exc = fut.exception()
+            if isinstance(exc, BrokenProcessPool):
+                reset_pool()
+            if not exc:
+                _record(fut.result())
+            finished(filename, i, str(exc) if exc else None, dest, raw)
+
+    try:
+        for path, filename in sources:
+            fopts = options_for(filename, opts, file_opts)
+            indices = wanted_indices(filename, fopts, variants)
+            if not indices:
+                continue
+            while len(staged) >= workers:
+                collect()
+            error = None
+            try:
+                with metrics.span('decode'):
+                    img = Image.open(path)
+                    img.load()
+            except (OSError, ValueError):
+                error = 'not a readable image'
+            else:
+                try:
+                    src = share_source(img)
+                except OSError as e:
+                    error = f'could not stage decoded pixels: {e}'
+            if error:
+                for i in indices:
+                    failures.append((filename, i, error))
+                    if on_variant:
+                        on_variant(filename, i, error, None)
+                continue
+            staged[src['path']] = len(indices)
+            sha256 = source_sha256(checksums, filename, path)
+            for i in indices:
+                dest = os.path.join(output_folder, variant_name(filename, i, '.jpg'))
+                args = (src, draw_params(fopts, variant_rng(fopts, sha256, i)), dest, pipeline)
+                if pool is None:
+                    error = None
+                    try:
+                        _record(render_variant(*args))
+                    except Exception as e:
+                        error = str(e)
+                    finished(filename, i, error, dest, src['path'])
+                else:
+                    tasks[pool.submit(render_variant, *args)] = (filename, i, dest, src['path'])
+        while tasks:
+            collect()
+    finally:
+        for fut in tasks:
+            fut.cancel()
+        for raw in staged:
+            os.remove(raw)
+    return failures
+
+# -------------------- Pipeline Comparison --------------------
+def _measure(path, pipeline, params_list, out):
+    img = Image.open(path)
+    img.load()
+    mean = grey_mean(img)
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for p in params_list:
+        t0 = time.perf_counter()
+        if pipeline == 'fused':
+            apply_params_fused(img, p, mean)
+        else:
+            apply_params(img, p)
+        times.append(time.perf_counter() - t0)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss
+    out.put({'pipeline': pipeline, 'peak_extra_kib': peak,
+             'ms_per_variant': 1000 * sum(times) / len(times)})
+
+def compare_pipelines(path, variants=10, intensity=100):
+    """Peak extra RSS and per-variant transform time of each pipeline.
+
+    Each pipeline runs in a fresh process so peaks don't mask each other.
+    """
+    opts = {'batch_size': variants, 'intensity': intensity, 'adjust_contrast': True,
+            'adjust_brightness': True, 'rotate': True, 'crop': True, 'flip_horizontal': True}
+    params_list = [draw_params(opts) for _ in range(variants)]
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for pipeline in PIPELINES:
+        out = ctx.Queue()
+        proc = ctx.Process(target=_measure, args=(path, pipeline, params_list, out))
+        proc.start()
+        results.append(out.get())
+        proc.join()
+    return results
+
+def check_pipelines(path, variants=50, intensity=100):
+    """Share of pixels that differ between the pipelines, worst variant first.
+
+    The fused pipeline is meant to be a drop-in replacement, so anything but
+    zero is a bug. Every mode it handles is checked.
+    """
+    from PIL import ImageChops
+    opts = {'batch_size': variants, 'intensity': intensity, 'adjust_contrast': True,
+            'adjust_brightness': True, 'rotate': True, 'crop': True, 'flip_horizontal': True}
+    rng = random.Random(0)
+    params_list = [draw_params(opts, rng) for _ in range(variants)]
+    src = Image.open(path)
+    src.load()
+    worst = []
+    for mode in FUSED_MODES:
+        img = src.convert(mode)
+        mean = grey_mean(img)
+        for p in params_list:
+            chained, fused = apply_params(img, p), apply_params_fused(img, p, mean)
+            if chained.size != fused.size:
+                worst.append({'mode': mode, 'params': p, 'mismatched': 1.0})
+                continue
+            diff = ImageChops.difference(chained, fused).convert('L').point([0] + [1] * 255)
+            mismatched = diff.histogram()[1] / (diff.width * diff.height)
+            worst.append({'mode': mode, 'params': p, 'mismatched': mismatched})
+    return sorted(worst, key=lambda r: -r['mismatched'])
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] not in ('compare', 'check'):
+        sys.exit('usage: python image_engine.py compare|check <image>')
+    if sys.argv[1] == 'check':
+        results = check_pipelines(sys.argv[2])
+        differing = sum(1 for r in results if r['mismatched'])
+        print(json.dumps({'variants': len(results), 'differing': differing, 'worst': results[0]},
+                         indent=2))
+        sys.exit(1 if results[0]['mismatched'] else 0)
+    print(json.dumps(compare_pipelines(sys.argv[2]), indent=2))
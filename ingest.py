@@ -0,0 +1,68 @@
+"""Streaming upload ingest.
+
+Multipart file parts are written chunk by chunk into the request's job
+spool directory and hashed on the way in, so an upload never has to sit
+in worker memory or be copied out of a temp file afterwards.
+"""
+import hashlib
+import io
+import os
+import shutil
+import uuid
+
+from flask import Request, request
+
+from jobs import SPOOL_FOLDER, new_job_id, spool_dir
+
+class SpoolFile(io.FileIO):
+    """Spool file that keeps a running sha256 of everything written to it."""
+
+    def __init__(self, path):
+        super().__init__(path, 'w+')
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, b):
+        self.sha256.update(b)
+        self.size += len(b)
+        return super().write(b)
+
+class SpoolingRequest(Request):
+    spool_id = None
+    spool_claimed = False
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        if self.spool_id is None:
+            self.spool_id = new_job_id()
+        return SpoolFile(os.path.join(spool_dir(self.spool_id), f'.part-{uuid.uuid4().hex}'))
+
+def claim_upload(upload, folder, filename):
+    """Move a spooled upload to ``folder/filename``; returns its sha256."""
+    dest = os.path.join(folder, filename)
+    stream = upload.stream
+    request.spool_claimed = True
+    if isinstance(stream, SpoolFile):
+        stream.close()
+        os.replace(stream.name, dest)
+        return stream.sha256.hexdigest()
+    digest = hashlib.sha256()
+    with open(dest, 'wb') as f:
+        for chunk in iter(lambda: stream.read(1 << 20), b''):
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+def discard_upload(upload):
+    """Drop a spooled upload that will not be claimed."""
+    stream = upload.stream
+    stream.close()
+    if isinstance(stream, SpoolFile):
+        try:
+            os.remove(stream.name)
+        except FileNotFoundError:
+            pass
+
+def discard_unclaimed_spool(exc=None):
+    if request.spool_id and not request.spool_claimed:
+        shutil.rmtree(os.path.join(SPOOL_FOLDER, request.spool_id), ignore_errors=True)
@@ -0,0 +1,506 @@
+"""Background job queue for the image/video processors.
+
+Jobs are rows in the app database; any process can enqueue them and any
+worker thread (embedded in the web process, or started with
+``python jobs.py``) can claim them.
+"""
+from dotenv import load_dotenv
+import os
+
+load_dotenv()
+
+import datetime
+import json
+import shutil
+import threading
+import time
+import traceback
+import uuid
+import zipfile
+
+from flask import Blueprint, Response, current_app, jsonify, abort, stream_with_context, url_for
+from flask_login import login_required, current_user
+
+import metrics
+
+jobs_bp = Blueprint('jobs', __name__)
+
+SPOOL_FOLDER = 'uploads'
+ZIP_FOLDER = os.path.join('static', 'processed_zips')
+POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 1.0))
+DOWNLOAD_RETRY_AFTER = 5  # seconds a client should wait before asking for an unfinished zip
+FAILURES_INLINE = 100  # failures listed in a job's status; the batch results page the rest
+
+_workers_lock = threading.Lock()
+_workers = []
+_last_reap = 0.0
+
+def get_models():
+    from app import db, Job, User
+    return db, Job, User
+
+def utcnow():
+    return datetime.datetime.utcnow()
+
+# -------------------- Enqueue --------------------
+def new_job_id():
+    return uuid.uuid4().hex
+
+def spool_dir(job_id):
+    path = os.path.join(SPOOL_FOLDER, job_id)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def enqueue(job_id, kind, user_id, opts, filenames, checksums=None, probes=None, profile=False,
+            cost=0, file_opts=None, sources=None):
+    """Queue a job; ``file_opts`` maps filename to options replacing ``opts``.
+
+    ``sources`` maps filenames to files the worker links into the spool dir
+    itself. Inputs without a checksum or probe are hashed and probed by the
+    worker, and a job queued without ``probes`` is charged there too.
+    """
+    from processing import options_for
+    db, Job, _ = get_models()
+    # counters only: outputs are ProcessedFile rows (see job_outputs) and
+    # failures JobFailure rows (see job_failures), so this stays small
+    progress = {
+        'files_total': len(filenames),
+        'variants_total': sum(options_for(f, opts, file_opts)['batch_size'] for f in filenames),
+        'variants_done': 0,
+        'variants_failed': 0,
+    }
+    job = Job(id=job_id, user_id=user_id, kind=kind, cost=cost,
+              params=json.dumps({'opts': opts, 'files': filenames, 'sha256': checksums or {},
+                                 'probes': probes, 'profile': profile,
+                                 'file_opts': file_opts or {}, 'sources': sources or {}}),
+              progress=json.dumps(progress))
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+# -------------------- Worker Pool --------------------
+def claim_next():
+    """Claim the oldest queued job its owner's plan may start, paid plans first."""
+    import admission
+    global _last_reap
+    db, Job, User = get_models()
+    if time.monotonic() - _last_reap >= current_app.config['JOB_HEARTBEAT']:
+        # lost jobs still count against running caps until they are reaped
+        _last_reap = time.monotonic()
+        reap_lost_jobs(current_app)
+        # and backups a dead process was uploading
+        import backup
+        backup.resume()
+    # priority is ordered in SQL: sorting a page of the oldest jobs would starve
+    # paid jobs queued behind a backlog of free ones
+    candidates = (db.session.query(Job.id, User.plan).join(User, User.id == Job.user_id)
+                  .filter(Job.status == 'queued')
+                  .order_by(admission.claim_priority(User), Job.created_at).limit(50).all())
+    for job_id, plan in candidates:
+        # conditional update so two workers never run the same job or exceed a cap
+        claimed = Job.query.filter(Job.id == job_id, Job.status == 'queued',
+                                   *admission.claim_filters(Job, User, plan)).update(
+            {'status': 'running', 'started_at': utcnow(), 'updated_at': utcnow()},
+            synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return job_id
+    return None
+
+class Progress:
+    def __init__(self, job):
+        self.job = job
+        self.data = json.loads(job.progress)
+        self.first_error = None
+
+    def variant_done(self, filename, index, error=None):
+        """Record a finished variant; its output row is committed along with it."""
+        from app import JobFailure
+        db, _, _ = get_models()
+        if error:
+            self.data['variants_failed'] += 1
+            self.first_error = self.first_error or error
+            db.session.add(JobFailure(job_id=self.job.id, file=filename, variant=index + 1,
+                                      error=error))
+        else:
+            self.data['variants_done'] += 1
+        self.job.progress = json.dumps(self.data)
+        self.job.updated_at = utcnow()
+        db.session.commit()
+
+    def input_failed(self, filename, variants, error):
+        """Fail every variant of an input that could not be read."""
+        from app import JobFailure
+        db, _, _ = get_models()
+        self.data['variants_failed'] += variants
+        self.first_error = self.first_error or error
+        db.session.add_all(JobFailure(job_id=self.job.id, file=filename, variant=i + 1, error=error)
+                           for i in range(variants))
+        self.job.progress = json.dumps(self.data)
+        self.job.updated_at = utcnow()
+        db.session.commit()
+
+def output_name(row):
+    """Name of an output inside the job's archive (history names carry the job id)."""
+    return row.filename.split('_', 1)[1]
+
+def job_outputs(job_id, after=0, limit=500):
+    """A page of a job's ProcessedFile rows with ids above ``after``, oldest first."""
+    from app import ProcessedFile
+    return (ProcessedFile.query.filter(ProcessedFile.job_id == job_id, ProcessedFile.id > after)
+            .order_by(ProcessedFile.id).limit(limit).all())
+
+def job_failures(job_id, after=0, limit=500):
+    """A page of a job's JobFailure rows with ids above ``after``, oldest first."""
+    from app import JobFailure
+    return (JobFailure.query.filter(JobFailure.job_id == job_id, JobFailure.id > after)
+            .order_by(JobFailure.id).limit(limit).all())
+
+def job_progress(job):
+    """The job's counters with per-file done/failed counts and its first failures.
+
+    Per-file counts are grouped from the output and failure rows rather than
+    kept in ``job.progress``, which is rewritten on every variant.
+    """
+    from processing import options_for
+    from sqlalchemy import func
+    from app import JobFailure, ProcessedFile
+    db, _, _ = get_models()
+    data = json.loads(job.progress)
+    params = json.loads(job.params)
+    done = dict(db.session.query(ProcessedFile.source, func.count(ProcessedFile.id))
+                .filter(ProcessedFile.job_id == job.id).group_by(ProcessedFile.source))
+    failed = dict(db.session.query(JobFailure.file, func.count(JobFailure.id))
+                  .filter(JobFailure.job_id == job.id).group_by(JobFailure.file))
+    data['files'] = [
+        {'name': f,
+         'variants_total': options_for(f, params['opts'], params.get('file_opts'))['batch_size'],
+         'variants_done': done.get(f, 0), 'variants_failed': failed.get(f, 0)}
+        for f in params['files']]
+    # capped; the batch results endpoint pages through all of them
+    data['failures'] = [{'file': r.file, 'variant': r.variant, 'error': r.error}
+                        for r in job_failures(job.id, limit=FAILURES_INLINE)]
+    return data
+
+def job_archive_entries(job):
+    """``(arcname, path)`` of every output of ``job``, read page by page."""
+    from processing import HISTORY_FOLDER
+    after = 0
+    while True:
+        rows = job_outputs(job.id, after)
+        for row in rows:
+            yield output_name(row), os.path.join(HISTORY_FOLDER, row.filename)
+        if not rows:
+            return
+        after = rows[-1].id
+
+def _prepare_inputs(job, params, progress):
+    """Link, hash and probe the inputs the submit left to the worker.
+
+    /batch only checks that its inputs exist, so a large manifest is queued
+    at once; an input that turns out unreadable or unsupported fails its own
+    variants here. Returns the inputs that are left.
+    """
+    import probe
+    import storage
+    from processing import options_for
+    src_dir = spool_dir(job.id)
+    sources, checksums = params['sources'], params['sha256']
+    probes = params['probes'] = params['probes'] or {}
+    files = []
+    with metrics.span('probe'):
+        for f in params['files']:
+            path = os.path.join(src_dir, f)
+            try:
+                if f in sources:
+                    storage.link(sources[f], path)
+                if not checksums.get(f):
+                    checksums[f] = storage.file_sha256(path)
+                if f not in probes:
+                    info = probe.probe(path, job.kind.rstrip('s'), checksums[f])
+                    probes[f] = probe.check_supported(info, current_app.config['MAX_SOURCE_PIXELS'])
+            except (probe.UnsupportedMedia, OSError) as e:
+                batch = options_for(f, params['opts'], params['file_opts'])['batch_size']
+                progress.input_failed(f, batch, str(e))
+                continue
+            files.append(f)
+    return files
+
+def _heartbeat(app, job_id, stop):
+    """Keep ``Job.updated_at`` fresh while a job runs, however long a variant takes."""
+    db, Job, _ = get_models()
+    while not stop.wait(app.config['JOB_HEARTBEAT']):
+        try:
+            with app.app_context():
+                Job.query.filter_by(id=job_id, status='running').update(
+                    {'updated_at': utcnow()}, synchronize_session=False)
+                db.session.commit()
+        except Exception:
+            app.logger.warning('heartbeat for job %s failed:\n%s', job_id, traceback.format_exc())
+
+def run_job(job_id):
+    """Run a job, timing it and (if it asked for one) dumping a cProfile."""
+    db, Job, _ = get_models()
+    job = db.session.get(Job, job_id)
+    stop = threading.Event()
+    beat = threading.Thread(target=_heartbeat, args=(current_app._get_current_object(), job_id, stop),
+                            name=f'heartbeat-{job_id[:8]}', daemon=True)
+    beat.start()
+    try:
+        with metrics.span('job'), metrics.profiled(f'job_{job_id}', json.loads(job.params).get('profile')):
+            _run_job(job_id)
+    finally:
+        stop.set()
+
+def _run_job(job_id):
+    """Render a job's variants into history.
+
+    Outputs are stored once in the blob store and hard-linked into history
+    under job-scoped names. With ``ARCHIVE_MODE='stored'`` each variant is
+    also appended to the job's zip as soon as it is finished. With
+    ``'stream'`` no archive is written; ``/jobs/<id>/download`` zips the
+    outputs on the fly. Variants already rendered for the same source,
+    settings and seed are served from the result cache instead.
+    """
+    from processing import (HISTORY_FOLDER, options_for, render_images, render_videos,
+                            variant_key, variant_name)
+    from archive import add_file, write_zip
+    from app import ProcessedFile
+    import admission
+    import storage
+    db, Job, User = get_models()
+    job = db.session.get(Job, job_id)
+    params = json.loads(job.params)
+    src_dir = os.path.join(SPOOL_FOLDER, job.id)
+    output_folder = os.path.join('processed', job.id)
+    os.makedirs(output_folder, exist_ok=True)
+    stored = current_app.config['ARCHIVE_MODE'] == 'stored'
+    progress = Progress(job)
+    zf = zip_fn = zip_path = None
+    timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    if stored:
+        zip_fn = f"{job.kind}_{timestamp}_{job.id}.zip"
+        zip_path = os.path.join(ZIP_FOLDER, zip_fn)
+        zf = zipfile.ZipFile(zip_path, 'w')
+
+    params.setdefault('sources', {})
+    opts = params['opts']
+    file_opts = params.setdefault('file_opts', {})
+    checksums = params['sha256']
+
+    def cache_key(filename, index):
+        fopts = options_for(filename, opts, file_opts)
+        if fopts.get('seed') is None or not checksums.get(filename):
+            return None
+        return variant_key(job.kind, checksums[filename], fopts, index)
+
+    def publish(filename, index, name, digest, blob, cached=False):
+        # the full job id: names must never collide across jobs (or users)
+        history_name = f"{job.id}_{name}"
+        try:
+            # history is a hard link to the blob, never a copy
+            with metrics.span('store'):
+                storage.link(blob, os.path.join(HISTORY_FOLDER, history_name))
+        except FileNotFoundError:
+            if cached:
+                return False  # swept since it was cached; render it again
+            raise
+        size = os.path.getsize(blob)
+        db.session.add(ProcessedFile(
+            user_id=job.user_id, job_id=job.id, filename=history_name, source=filename,
+            sha256=digest, size=size, kind=job.kind.rstrip('s')))
+        metrics.inc('variants_cached_total' if cached else 'variants_produced_total', kind=job.kind)
+        metrics.inc('bytes_out_total', size, kind=job.kind)
+        if zf:
+            with metrics.span('zip'):
+                add_file(zf, blob, name)
+        progress.variant_done(filename, index)
+        return True
+
+    def on_variant(filename, index, error=None, path=None):
+        if not path:
+            metrics.inc('variants_failed_total', kind=job.kind)
+            progress.variant_done(filename, index, error)
+            return
+        # staged output moves into the blob store
+        with metrics.span('store'):
+            digest, blob = storage.put(path)
+        key = cache_key(filename, index)
+        if key:
+            storage.remember_result(key, digest, os.path.splitext(blob)[1])
+        publish(filename, index, os.path.basename(path), digest, blob)
+
+    try:
+        charge = params['probes'] is None
+        files = _prepare_inputs(job, params, progress)
+        if not files:
+            raise RuntimeError(f'no readable inputs: {progress.first_error}')
+        if charge:
+            admission.reserve(job, {f: params['probes'][f] for f in files}, opts, file_opts)
+            job.params = json.dumps(params)
+            db.session.commit()
+        ext = '.jpg' if job.kind == 'images' else '.mp4'
+        todo = {}
+        for f in files:
+            todo[f] = []
+            for i in range(options_for(f, opts, file_opts)['batch_size']):
+                key = cache_key(f, i)
+                hit = key and storage.cached_result(key)
+                if not (hit and publish(f, i, variant_name(f, i, ext), *hit, cached=True)):
+                    todo[f].append(i)
+        sources = [(os.path.join(src_dir, f), f) for f in files if todo[f]]
+        render = render_images if job.kind == 'images' else render_videos
+        stats = {}
+        failures = render(sources, output_folder, opts, on_variant, probes=params.get('probes'),
+                          stats=stats, checksums=checksums, variants=todo,
+                          file_opts=file_opts) if sources else []
+        status, error = 'done', None
+        if stats.get('encode_seconds'):
+            progress.data['encode'] = {
+                'profile': opts.get('encode_profile'),
+                'frames': int(stats['frames']),
+                'encode_seconds': round(stats['encode_seconds'], 3),
+                'fps': round(stats['frames'] / stats['encode_seconds'], 1),
+            }
+            job.progress = json.dumps(progress.data)
+        if failures and not progress.data['variants_done']:
+            raise RuntimeError(f'all variants failed: {failures[0][2]}')
+        if zf:
+            zf.close()
+        user = db.session.get(User, job.user_id)
+        if user and user.backup_enabled:
+            import backup
+            backup_fn = zip_fn or f"{job.kind}_{timestamp}_{job.id}.zip"
+            if stored:
+                backup.submit(zip_path, backup_fn)
+            else:
+                pending = os.path.join(backup.PENDING_FOLDER, backup_fn)
+                with metrics.span('zip'):
+                    write_zip(job_archive_entries(job), pending)
+                backup.submit(pending, backup_fn, delete_after=True)
+        db.session.commit()
+    except Exception as e:
+        # a failed flush leaves the session unusable until it is rolled back
+        db.session.rollback()
+        current_app.logger.error('job %s failed:\n%s', job_id, traceback.format_exc())
+        status, error, zip_fn = 'failed', str(e), None
+        if zf:
+            zf.close()
+            os.remove(zip_path)
+    finally:
+        shutil.rmtree(output_folder, ignore_errors=True)
+        shutil.rmtree(src_dir, ignore_errors=True)
+    job = db.session.get(Job, job_id, populate_existing=True)
+    if job.status != 'running':
+        # reaped as lost while we worked; its tokens were refunded then
+        current_app.logger.warning('job %s finished after it was reaped', job_id)
+        return
+    job.status, job.error, job.zip_filename, job.finished_at = status, error, zip_fn, utcnow()
+    admission.settle(job, progress.data['variants_total'], progress.data['variants_failed'])
+    db.session.commit()
+    metrics.inc('jobs_total', kind=job.kind, status=job.status)
+
+def _worker_loop(app, stop):
+    while not stop.is_set():
+        job_id = None
+        try:
+            with app.app_context():
+                job_id = claim_next()
+                if job_id:
+                    run_job(job_id)
+        except Exception:
+            app.logger.error('job worker error:\n%s', traceback.format_exc())
+        if not job_id:
+            stop.wait(POLL_INTERVAL)
+
+def reap_lost_jobs(app):
+    """Fail and refund running jobs whose heartbeat stopped (worker killed, deploy)."""
+    import admission
+    db, Job, _ = get_models()
+    cutoff = utcnow() - datetime.timedelta(seconds=app.config['JOB_LOST_SECONDS'])
+    lost = Job.status == 'running', db.func.coalesce(Job.updated_at, Job.started_at) < cutoff
+    for (job_id,) in db.session.query(Job.id).filter(*lost).all():
+        # conditional update: only one process may fail (and refund) a job
+        reaped = Job.query.filter(Job.id == job_id, *lost).update(
+            {'status': 'failed', 'error': 'worker lost', 'finished_at': utcnow()},
+            synchronize_session=False)
+        if reaped:
+            job = db.session.get(Job, job_id, populate_existing=True)
+            admission.refund(job, job.cost or 0)
+        db.session.commit()
+
+def ensure_workers(app):
+    with _workers_lock:
+        if _workers:
+            return
+        with app.app_context():
+            import backup
+            reap_lost_jobs(app)
+            backup.resume()  # queued before a restart
+        stop = threading.Event()
+        for n in range(app.config['JOB_WORKERS']):
+            t = threading.Thread(target=_worker_loop, args=(app, stop),
+                                 name=f'job-worker-{n}', daemon=True)
+            t.start()
+            _workers.append(t)
+
+@jobs_bp.before_app_request
+def start_embedded_workers():
+    if current_app.config['JOB_WORKERS_EMBEDDED']:
+        ensure_workers(current_app._get_current_object())
+
+# -------------------- Status --------------------
+@jobs_bp.route('/<job_id>')
+@login_required
+def job_status(job_id):
+    db, Job, _ = get_models()
+    job = db.session.get(Job, job_id)
+    if job is None or job.user_id != current_user.id:
+        abort(404)
+    data = {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': job_progress(job),
+        'zip_filename': job.zip_filename,
+        'error': job.error,
+        'cost': job.cost,
+        'seed': json.loads(job.params)['opts'].get('seed'),
+    }
+    if job.zip_filename:
+        data['download_url'] = url_for('download_zip', filename=job.zip_filename)
+    elif job.status == 'done':
+        data['download_url'] = url_for('jobs.job_download', job_id=job.id)
+    return jsonify(data)
+
+@jobs_bp.route('/<job_id>/download')
+@login_required
+def job_download(job_id):
+    from archive import stream_zip
+    db, Job, _ = get_models()
+    job = db.session.get(Job, job_id)
+    if job is None or job.user_id != current_user.id or job.status == 'failed':
+        abort(404)
+    if job.status != 'done':
+        # waiting here would hold a (sync) worker for the whole job
+        response = jsonify({'error': 'job is not finished yet', 'status': job.status})
+        response.headers['Retry-After'] = str(DOWNLOAD_RETRY_AFTER)
+        return response, 409
+    fn = f"{job.kind}_{job.finished_at:%Y%m%d%H%M%S}_{job.id[:8]}.zip"
+
+    def counted(chunks):
+        for chunk in chunks:
+            metrics.inc('download_bytes_total', len(chunk))
+            yield chunk
+
+    # entries are read from the database as the zip is written
+    return Response(stream_with_context(counted(stream_zip(job_archive_entries(job)))),
+                    mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename="{fn}"'})
+
+if __name__ == '__main__':
+    from app import app
+    import jobs
+    jobs.ensure_workers(app)
+    for t in jobs._workers:
+        t.join()
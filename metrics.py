@@ -0,0 +1,236 @@
+"""Per-stage timings, counters and a Prometheus text endpoint.
+
+Stages: ``upload`` (multipart ingest), ``probe``, ``decode`` (PIL open +
+load), ``transform``, ``encode`` (JPEG save), ``ffmpeg``, ``store`` (blob
+store + history link), ``zip``, ``backup`` and ``job`` (whole job). Image
+transform/encode spans are timed inside pool workers and reported back
+with each variant's result.
+
+Metrics are recorded per process. A scrape reaches one gunicorn worker
+only, so with more than one process set ``METRICS_DIR`` to a directory
+they all share: each process writes its totals there every few seconds
+and ``/metrics`` adds up every file (gunicorn.conf.py empties it when the
+server starts). Files of exited processes are folded into one aggregate
+file when scraped. Without it, /metrics is only complete for a single worker.
+"""
+import atexit
+import cProfile
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import Blueprint, Response, abort, current_app, request
+
+metrics_bp = Blueprint('metrics', __name__)
+
+PROFILE_FOLDER = 'profiles'
+METRICS_DIR = os.getenv('METRICS_DIR')
+FLUSH_INTERVAL = 5  # seconds between writes of this process's totals
+EXITED_FILE = 'exited.json'  # totals of processes that have exited
+
+_lock = threading.Lock()
+_stage_count = defaultdict(int)
+_stage_sum = defaultdict(float)
+_counters = defaultdict(float)
+_last_flush = 0.0
+_file = (None, None)  # (pid, name) of this process's file
+
+COUNTER_HELP = {
+    'variants_produced_total': 'Variants written, by job kind.',
+    'variants_cached_total': 'Variants served from the result cache, by job kind.',
+    'variants_failed_total': 'Variants that failed, by job kind.',
+    'bytes_in_total': 'Uploaded source bytes, by job kind.',
+    'bytes_out_total': 'Variant bytes produced, by job kind.',
+    'download_bytes_total': 'Archive bytes streamed to clients.',
+    'jobs_total': 'Finished jobs, by kind and status.',
+}
+
+# -------------------- Recording --------------------
+def observe(stage, seconds):
+    with _lock:
+        _stage_count[stage] += 1
+        _stage_sum[stage] += seconds
+    _maybe_flush()
+
+@contextmanager
+def span(stage):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - t0)
+
+def inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] += value
+    _maybe_flush()
+
+@contextmanager
+def profiled(name, enabled=True):
+    """Dump a cProfile of the block to ``profiles/<name>.prof`` (snakeviz/flameprof)."""
+    if not enabled:
+        yield None
+        return
+    os.makedirs(PROFILE_FOLDER, exist_ok=True)
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield prof
+    finally:
+        prof.disable()
+        prof.dump_stats(os.path.join(PROFILE_FOLDER, f'{name}.prof'))
+
+# -------------------- Sharing --------------------
+def _snapshot():
+    with _lock:
+        return dict(_stage_count), dict(_stage_sum), dict(_counters)
+
+def _file_name():
+    """``<pid>-<uuid>.json``: a reused pid must not overwrite an exited process's file."""
+    global _file
+    if _file[0] != os.getpid():
+        _file = (os.getpid(), f'{os.getpid()}-{uuid.uuid4().hex}.json')
+    return _file[1]
+
+def _encode(counts, sums, counters):
+    return {'stages': {s: [counts[s], sums[s]] for s in counts},
+            'counters': [[n, labels, v] for (n, labels), v in counters.items()]}
+
+def _write(path, data):
+    tmp = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+def flush():
+    """Write this process's totals to ``METRICS_DIR/<pid>-<uuid>.json``."""
+    global _last_flush
+    _last_flush = time.monotonic()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    _write(os.path.join(METRICS_DIR, _file_name()), _encode(*_snapshot()))
+
+def _maybe_flush(force=False):
+    if METRICS_DIR and (force or time.monotonic() - _last_flush >= FLUSH_INTERVAL):
+        try:
+            flush()
+        except OSError:
+            pass  # metrics must never fail a request
+
+def _add(totals, data):
+    counts, sums, counters = totals
+    for stage, (count, total) in data['stages'].items():
+        counts[stage] += count
+        sums[stage] += total
+    for n, labels, value in data['counters']:
+        counters[(n, tuple(map(tuple, labels)))] += value
+
+def _exited(name):
+    try:
+        os.kill(int(name.split('-', 1)[0]), 0)
+    except ProcessLookupError:
+        return True
+    except (ValueError, PermissionError):
+        pass
+    return False
+
+def _read(name):
+    try:
+        with open(os.path.join(METRICS_DIR, name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _fold(names):
+    """Add exited processes' files to ``EXITED_FILE`` and remove them.
+
+    The aggregate lists the files already folded into it, so a file left
+    behind by an interrupted fold is never counted twice.
+    """
+    exited = _read(EXITED_FILE) or {'stages': {}, 'counters': [], 'folded': []}
+    totals = (defaultdict(int), defaultdict(float), defaultdict(float))
+    _add(totals, exited)
+    folded = {n for n in exited['folded'] if n in names}
+    for name in names - folded:
+        data = _read(name)
+        if data is not None:
+            _add(totals, data)
+            folded.add(name)
+    _write(os.path.join(METRICS_DIR, EXITED_FILE), {**_encode(*totals), 'folded': sorted(folded)})
+    for name in folded:
+        try:
+            os.unlink(os.path.join(METRICS_DIR, name))
+        except FileNotFoundError:
+            pass
+
+def _collect():
+    """Totals of every process sharing ``METRICS_DIR`` (exited ones included)."""
+    if not METRICS_DIR:
+        return _snapshot()
+    _maybe_flush(force=True)
+    own = _file_name()
+    totals = (defaultdict(int), defaultdict(float), defaultdict(float))
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        # one scrape at a time, so a file is never folded and read twice
+        with open(os.path.join(METRICS_DIR, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            names = {n for n in os.listdir(METRICS_DIR)
+                     if n.endswith('.json') and n not in (own, EXITED_FILE)}
+            exited = {n for n in names if _exited(n)}
+            if exited:
+                _fold(exited)
+            for name in [EXITED_FILE, *(names - exited)]:
+                data = _read(name)
+                if data is not None:
+                    _add(totals, data)
+    except OSError:
+        # serve this process's totals rather than fail the scrape
+        return _snapshot()
+    # this process's own totals come from memory, written or not
+    counts, sums, counters = _snapshot()
+    _add(totals, _encode(counts, sums, counters))
+    return totals
+
+if METRICS_DIR:
+    atexit.register(_maybe_flush, force=True)
+
+# -------------------- Exposition --------------------
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+def _number(value):
+    # exact: '{:g}' would print 1234567891 as 1.23457e+09
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def render_prometheus():
+    counts, sums, counters = _collect()
+    stages = sorted(counts)
+    lines = [
+        '# HELP metadata_changer_stage_seconds Time spent per pipeline stage.',
+        '# TYPE metadata_changer_stage_seconds summary',
+    ]
+    for stage in stages:
+        lines.append(f'metadata_changer_stage_seconds_count{{stage="{stage}"}} {counts[stage]}')
+        lines.append(f'metadata_changer_stage_seconds_sum{{stage="{stage}"}} {sums[stage]:.6f}')
+    for name in sorted({n for n, _ in counters}):
+        lines.append(f'# HELP metadata_changer_{name} {COUNTER_HELP.get(name, name)}')
+        lines.append(f'# TYPE metadata_changer_{name} counter')
+        for (n, labels), value in sorted(counters.items()):
+            if n == name:
+                lines.append(f'metadata_changer_{name}{_labels(labels)} {_number(value)}')
+    return '\n'.join(lines) + '\n'
+
+@metrics_bp.route('/metrics')
+def metrics():
+    token = current_app.config.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(401)
+    return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
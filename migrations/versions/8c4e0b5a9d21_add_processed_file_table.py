@@ -0,0 +1,44 @@
+"""Add processed_file table for indexed history
+
+Revision ID: 8c4e0b5a9d21
+Revises: 3f1a9c2d7e10
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4e0b5a9d21'
+down_revision = '3f1a9c2d7e10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('processed_file',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('job_id', sa.String(length=32), nullable=True),
+        sa.Column('filename', sa.String(length=255), nullable=False),
+        sa.Column('sha256', sa.String(length=64), nullable=False),
+        sa.Column('size', sa.BigInteger(), nullable=False),
+        sa.Column('kind', sa.String(length=10), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['job_id'], ['job.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('filename')
+    )
+    with op.batch_alter_table('processed_file', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_processed_file_job_id'), ['job_id'], unique=False)
+        batch_op.create_index('ix_processed_file_user_created', ['user_id', 'created_at', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('processed_file', schema=None) as batch_op:
+        batch_op.drop_index('ix_processed_file_user_created')
+        batch_op.drop_index(batch_op.f('ix_processed_file_job_id'))
+
+    op.drop_table('processed_file')
@@ -0,0 +1,26 @@
+"""Add job.updated_at heartbeat
+
+Revision ID: a41e6b7c3f58
+Revises: d2a7f4c1e903
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a41e6b7c3f58'
+down_revision = 'd2a7f4c1e903'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('job', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('job', schema=None) as batch_op:
+        batch_op.drop_column('updated_at')
@@ -0,0 +1,26 @@
+"""Add processed_file.source
+
+Revision ID: c7d3e91f2b64
+Revises: a41e6b7c3f58
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d3e91f2b64'
+down_revision = 'a41e6b7c3f58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('processed_file', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('source', sa.String(length=255), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('processed_file', schema=None) as batch_op:
+        batch_op.drop_column('source')
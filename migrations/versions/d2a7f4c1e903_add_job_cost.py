@@ -0,0 +1,26 @@
+"""Add job.cost for token reservations
+
+Revision ID: d2a7f4c1e903
+Revises: 8c4e0b5a9d21
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2a7f4c1e903'
+down_revision = '8c4e0b5a9d21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('job', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('cost', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('job', schema=None) as batch_op:
+        batch_op.drop_column('cost')
@@ -0,0 +1,37 @@
+"""Add job_failure table for per-variant failures
+
+Revision ID: e5b8c2f4a716
+Revises: c7d3e91f2b64
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b8c2f4a716'
+down_revision = 'c7d3e91f2b64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('job_failure',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('job_id', sa.String(length=32), nullable=False),
+        sa.Column('file', sa.String(length=255), nullable=False),
+        sa.Column('variant', sa.Integer(), nullable=False),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.ForeignKeyConstraint(['job_id'], ['job.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('job_failure', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_job_failure_job_id'), ['job_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('job_failure', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_job_failure_job_id'))
+
+    op.drop_table('job_failure')
@@ -0,0 +1,38 @@
+"""Add backup table for the durable backup queue
+
+Revision ID: f1c6a3d8b290
+Revises: e5b8c2f4a716
+Create Date: 2026-10-18 21:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1c6a3d8b290'
+down_revision = 'e5b8c2f4a716'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('backup',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('host', sa.String(length=255), nullable=False),
+        sa.Column('path', sa.String(length=500), nullable=False),
+        sa.Column('name', sa.String(length=200), nullable=False),
+        sa.Column('delete_after', sa.Boolean(), nullable=False),
+        sa.Column('claimed_at', sa.DateTime(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('backup', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_backup_host'), ['host'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('backup', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_backup_host'))
+
+    op.drop_table('backup')
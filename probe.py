@@ -0,0 +1,146 @@
+"""Cached media probing.
+
+Probe results (geometry, duration, codec, rotation) are keyed by the
+upload's sha256, which ingest computes anyway. They are kept in an
+in-process LRU backed by small JSON files, so re-uploaded clips never
+spawn ffprobe twice. Images are probed from their header with PIL.
+Reading a file refreshes its mtime; retention.py removes files unused for
+``PROBE_RETENTION_DAYS`` with sweep().
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+PROBE_FOLDER = os.path.join('storage', 'probes')
+IMAGE_FORMAT_HINTS = ('image2', '_pipe')
+
+_lock = threading.Lock()
+_cache = OrderedDict()
+_cache_size = 1024
+
+class UnsupportedMedia(ValueError):
+    pass
+
+def configure(cache_size):
+    global _cache_size
+    _cache_size = cache_size
+
+# -------------------- Probers --------------------
+def _ratio(value):
+    num, _, den = (value or '0/1').partition('/')
+    return float(num) / float(den or 1) if float(den or 1) else 0.0
+
+def probe_video(path):
+    import ffmpeg
+    try:
+        data = ffmpeg.probe(path)
+    except ffmpeg.Error:
+        raise UnsupportedMedia('not a readable video') from None
+    fmt = data.get('format', {})
+    if any(h in fmt.get('format_name', '') for h in IMAGE_FORMAT_HINTS):
+        raise UnsupportedMedia('still images are not supported as video')
+    v = next((s for s in data['streams'] if s['codec_type'] == 'video'), None)
+    if v is None or not v.get('width'):
+        raise UnsupportedMedia('no video stream')
+    a = next((s for s in data['streams'] if s['codec_type'] == 'audio'), None)
+    rotation = int(v.get('tags', {}).get('rotate', 0))
+    for side in v.get('side_data_list', []):
+        if 'rotation' in side:
+            rotation = -int(side['rotation'])
+    return {
+        'kind': 'video',
+        'width': int(v['width']),
+        'height': int(v['height']),
+        'duration': float(fmt.get('duration') or v.get('duration') or 0),
+        'fps': _ratio(v.get('avg_frame_rate') or v.get('r_frame_rate')),
+        'codec': v.get('codec_name'),
+        'audio_codec': a.get('codec_name') if a else None,
+        'rotation': rotation % 360,
+    }
+
+EXIF_ROTATION = {3: 180, 6: 270, 8: 90}
+
+def probe_image(path):
+    from PIL import Image
+    try:
+        with Image.open(path) as img:
+            orientation = img.getexif().get(0x0112, 1)
+            return {
+                'kind': 'image',
+                'width': img.width,
+                'height': img.height,
+                'duration': 0.0,
+                'codec': img.format,
+                'mode': img.mode,
+                'rotation': EXIF_ROTATION.get(orientation, 0),
+            }
+    except (OSError, ValueError, Image.DecompressionBombError):
+        raise UnsupportedMedia('not a readable image') from None
+
+# -------------------- Cache --------------------
+def _disk_path(sha256, kind):
+    return os.path.join(PROBE_FOLDER, sha256[:2], f'{sha256}.{kind}.json')
+
+def _remember(key, info):
+    with _lock:
+        _cache[key] = info
+        _cache.move_to_end(key)
+        while len(_cache) > _cache_size:
+            _cache.popitem(last=False)
+
+def probe(path, kind, sha256=None):
+    """Probe ``path`` as ``'image'`` or ``'video'``; raises UnsupportedMedia."""
+    prober = probe_image if kind == 'image' else probe_video
+    if sha256 is None:
+        return prober(path)
+    key = (sha256, kind)
+    with _lock:
+        info = _cache.get(key)
+        if info is not None:
+            _cache.move_to_end(key)
+            return info
+    disk = _disk_path(sha256, kind)
+    try:
+        with open(disk) as f:
+            info = json.load(f)
+        os.utime(disk)  # used again: restart its retention clock
+    except (OSError, ValueError):
+        info = prober(path)
+        os.makedirs(os.path.dirname(disk), exist_ok=True)
+        tmp = f'{disk}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(info, f)
+        os.replace(tmp, disk)
+    _remember(key, info)
+    return info
+
+def sweep(max_age_seconds, shard=None, pace=None):
+    """Delete probe files unused for ``max_age_seconds``; returns the count.
+
+    ``shard`` and ``pace`` are as in storage.sweep().
+    """
+    removed = 0
+    cutoff = time.time() - max_age_seconds
+    top = os.path.join(PROBE_FOLDER, shard) if shard else PROBE_FOLDER
+    for root, _, files in os.walk(top):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                if os.stat(path).st_mtime >= cutoff:
+                    continue
+                if pace:
+                    pace()
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+    return removed
+
+def check_supported(info, max_pixels):
+    if info['width'] * info['height'] > max_pixels:
+        raise UnsupportedMedia(f"{info['width']}x{info['height']} exceeds the size limit")
+    if info['kind'] == 'video' and info['duration'] <= 0:
+        raise UnsupportedMedia('video has no duration')
+    return info
@@ -0,0 +1,427 @@
+import fcntl
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
+from flask import current_app
+
+import metrics
+import probe
+
+HISTORY_FOLDER = os.path.join('static', 'history')
+FFMPEG_SLOT_FOLDER = os.path.join('storage', 'ffmpeg_slots')
+RENDER_VERSION = 2  # bump when a change alters the output for the same seed
+
+_ffmpeg_slots = None
+_ffmpeg_slots_lock = threading.Lock()
+
+# ffmpeg output options per profile; 'max_side' caps the shorter dimension.
+# A hardware encoder is just another entry (e.g. vcodec='h264_nvenc').
+ENCODE_PROFILES = {
+    'ultrafast': {'vcodec': 'libx264', 'preset': 'ultrafast', 'crf': 28, 'max_side': 720},
+    'veryfast':  {'vcodec': 'libx264', 'preset': 'veryfast',  'crf': 23, 'max_side': 1080},
+    'medium':    {'vcodec': 'libx264', 'preset': 'medium',    'crf': 23, 'max_side': None},
+}
+
+# -------------------- Helpers --------------------
+def scale_range(min_val, max_val, intensity, rng=random):
+    factor = intensity / 100
+    return rng.uniform(min_val*factor, max_val*factor)
+
+def parse_seed(value):
+    try:
+        return int(value) % 2**32
+    except (TypeError, ValueError):
+        return random.SystemRandom().randrange(2**32)
+
+def parse_options(form):
+    profile = form.get('encode_profile')
+    if profile not in ENCODE_PROFILES:
+        profile = current_app.config.get('ENCODE_PROFILE', 'medium')
+    return {
+        'seed': parse_seed(form.get('seed')),
+        'encode_profile': profile,
+        'batch_size': int(form.get('batch_size', 5)),
+        'intensity': int(form.get('intensity', 30)),
+        'adjust_contrast': 'adjust_contrast' in form,
+        'adjust_brightness': 'adjust_brightness' in form,
+        'rotate': 'rotate' in form,
+        'crop': 'crop' in form,
+        'flip_horizontal': 'flip_horizontal' in form,
+    }
+
+def parse_json_options(settings):
+    """parse_options() for a JSON object; true/false stand in for checkboxes."""
+    return parse_options({k: v for k, v in settings.items() if v is not None and v is not False})
+
+# -------------------- Variants --------------------
+def variant_rng(opts, sha256, index):
+    """Random stream for one variant, fixed by (seed, source hash, index)."""
+    if opts.get('seed') is None:
+        return random  # jobs queued before seeds existed
+    return random.Random(f"{opts['seed']}:{sha256}:{index}")
+
+def variant_name(filename, index, ext):
+    return f"{os.path.splitext(filename)[0]}_variant_{index+1}{ext}"
+
+def variant_key(kind, sha256, opts, index):
+    """Result-cache key: everything that decides a variant's bytes."""
+    settings = {k: v for k, v in opts.items() if k != 'batch_size'}
+    if kind == 'images':
+        settings['pipeline'] = current_app.config.get('IMAGE_PIPELINE', 'fused')
+    data = json.dumps([RENDER_VERSION, kind, sha256, settings, index], sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+def source_sha256(checksums, filename, path):
+    if checksums and checksums.get(filename):
+        return checksums[filename]
+    import storage
+    return storage.file_sha256(path)
+
+def options_for(filename, opts, file_opts):
+    return (file_opts or {}).get(filename, opts)
+
+def wanted_indices(filename, opts, variants):
+    if variants is None:
+        return list(range(opts['batch_size']))
+    return variants.get(filename, [])
+
+# -------------------- Images --------------------
+def render_images(sources, output_folder, opts, on_variant=None, probes=None, stats=None,
+                  checksums=None, variants=None, file_opts=None):
+    """Render ``batch_size`` variants of every ``(path, filename)`` in sources.
+
+    Variants are spread over the image engine's process pool
+    (``IMAGE_WORKERS``, 1 renders inline) using ``IMAGE_PIPELINE``.
+    ``on_variant(filename, index, error, path)`` is called as each variant
+    lands in output_folder. ``checksums`` maps filename to sha256 for
+    seeding; ``variants`` maps filename to the indices to render (default
+    all); ``file_opts`` maps filename to options that replace ``opts`` for
+    that file. Returns a list of ``(filename, index, error)`` for variants
+    that failed.
+    """
+    import image_engine
+    workers = current_app.config.get('IMAGE_WORKERS') or os.cpu_count() or 1
+    return image_engine.render(sources, output_folder, opts, on_variant, workers,
+                               pipeline=current_app.config.get('IMAGE_PIPELINE', 'fused'),
+                               checksums=checksums, variants=variants, file_opts=file_opts)
+
+# -------------------- Videos --------------------
+def ffmpeg_pool_size():
+    """Return ``(processes, threads_per_process)`` for concurrent encodes."""
+    cpus = os.cpu_count() or 1
+    limit = current_app.config.get('FFMPEG_MAX_PROCS') or cpus
+    procs = max(1, min(limit, cpus))
+    return procs, max(1, cpus // procs)
+
+class FfmpegSlots:
+    """Host-wide cap on running ffmpeg encodes, shared by every job.
+
+    Each slot is a file under FFMPEG_SLOT_FOLDER held with flock(), so all
+    gunicorn workers and standalone job workers together stay within
+    ``FFMPEG_MAX_PROCS``, and the kernel frees the slots of a process that
+    dies. ``hold(n)`` takes ``n`` slots for a graph running ``n`` encoders.
+    """
+
+    def __init__(self, count, folder=FFMPEG_SLOT_FOLDER):
+        self.count = count
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def _open(self, name):
+        return os.open(os.path.join(self.folder, name), os.O_RDWR | os.O_CREAT, 0o644)
+
+    def _take(self):
+        for n in range(self.count):
+            fd = self._open(f'slot_{n}')
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    @contextmanager
+    def hold(self, n=1):
+        held = []
+        try:
+            # only one taker collects slots at a time, so two graphs that each
+            # hold part of what they need can never wait on each other
+            gate = self._open('gate')
+            try:
+                fcntl.flock(gate, fcntl.LOCK_EX)
+                while len(held) < min(n, self.count):
+                    fd = self._take()
+                    if fd is None:
+                        time.sleep(0.05)
+                    else:
+                        held.append(fd)
+            finally:
+                os.close(gate)
+            yield
+        finally:
+            for fd in held:
+                os.close(fd)
+
+def ffmpeg_slots():
+    """The host-wide FfmpegSlots, sized by ffmpeg_pool_size()."""
+    global _ffmpeg_slots
+    with _ffmpeg_slots_lock:
+        if _ffmpeg_slots is None:
+            _ffmpeg_slots = FfmpegSlots(ffmpeg_pool_size()[0])
+        return _ffmpeg_slots
+
+def has_video_filters(opts):
+    return any(opts[k] for k in ('adjust_contrast', 'adjust_brightness', 'rotate', 'crop', 'flip_horizontal'))
+
+def output_size(w, h, profile):
+    """Frame size after the profile's resolution cap, kept even for yuv420p."""
+    cap = profile.get('max_side')
+    if not cap or min(w, h) <= cap:
+        return w, h
+    f = cap / min(w, h)
+    return int(w*f)//2*2, int(h*f)//2*2
+
+def video_variant_chain(st, w, h, opts, size=None, rng=random):
+    intensity = opts['intensity']
+    tw, th = size or (w, h)
+    if opts['adjust_contrast'] or opts['adjust_brightness']:
+        c = 1+scale_range(-0.1,0.1,intensity,rng) if opts['adjust_contrast'] else 1
+        b = scale_range(-0.05,0.05,intensity,rng) if opts['adjust_brightness'] else 0
+        st = st.filter('eq',contrast=c,brightness=b)
+    if opts['rotate']:
+        st = st.filter('rotate', scale_range(-2,2,intensity,rng)*3.1415/180)
+    if opts['crop']:
+        dx,dy = int(w*scale_range(0.01,0.03,intensity,rng)), int(h*scale_range(0.01,0.03,intensity,rng))
+        st = st.filter('crop', w-2*dx, h-2*dy, dx, dy).filter('scale', tw, th)
+    elif (tw, th) != (w, h):
+        st = st.filter('scale', tw, th)
+    if opts['flip_horizontal'] and rng.random()>0.5:
+        st = st.filter('hflip')
+    return st
+
+def output_args(profile, info, threads):
+    args = {k: v for k, v in profile.items() if k != 'max_side'}
+    args['threads'] = threads
+    if info.get('audio_codec'):
+        # no filter touches audio, so AAC passes straight through
+        args['acodec'] = 'copy' if info['audio_codec'] == 'aac' else 'aac'
+    return args
+
+def _variant_output(inp, video, outp, info, args):
+    import ffmpeg
+    if info.get('audio_codec'):
+        return ffmpeg.output(video, inp.audio, outp, **args)
+    return ffmpeg.output(video, outp, **args)
+
+def display_size(info):
+    """Frame size after ffmpeg applies the stream's rotation metadata."""
+    if info.get('rotation') in (90, 270):
+        return info['height'], info['width']
+    return info['width'], info['height']
+
+def build_video_variant(src, outp, info, opts, threads, rng=random):
+    import ffmpeg
+    profile = ENCODE_PROFILES[opts.get('encode_profile', 'medium')]
+    w, h = display_size(info)
+    inp = ffmpeg.input(src)
+    video = video_variant_chain(inp.video, w, h, opts, output_size(w, h, profile), rng)
+    return _variant_output(inp, video, outp, info, output_args(profile, info, threads))
+
+def build_split_variants(src, outps, info, opts, threads, rngs=None):
+    """One graph that decodes ``src`` once and writes every path in ``outps``."""
+    import ffmpeg
+    profile = ENCODE_PROFILES[opts.get('encode_profile', 'medium')]
+    w, h = display_size(info)
+    inp = ffmpeg.input(src)
+    branches = inp.video.split()
+    args = output_args(profile, info, threads)
+    rngs = rngs or [random] * len(outps)
+    outputs = [
+        _variant_output(inp, video_variant_chain(branches[i], w, h, opts, output_size(w, h, profile),
+                                                 rngs[i]),
+                        outp, info, args)
+        for i, outp in enumerate(outps)
+    ]
+    return ffmpeg.merge_outputs(*outputs)
+
+def use_split_graph(w, h, opts):
+    mode = current_app.config.get('VIDEO_RENDER_MODE', 'auto')
+    if mode != 'auto':
+        return mode == 'split'
+    # decoding dominates for large sources; small ones parallelise better per variant
+    return (opts['batch_size'] > 1 and has_video_filters(opts)
+            and w * h >= current_app.config.get('VIDEO_SPLIT_MIN_PIXELS', 1280*720))
+
+# -------------------- Segmented Encoding --------------------
+def use_segments(info, procs):
+    """Long clips are cut at keyframes and their segments encoded in parallel."""
+    mode = current_app.config.get('VIDEO_RENDER_MODE', 'auto')
+    if mode not in ('auto', 'segmented') or info.get('rotation'):
+        return False  # stream-copied segments would not carry the rotation reliably
+    seconds = current_app.config.get('VIDEO_SEGMENT_SECONDS', 60)
+    if info['duration'] < 2 * seconds:
+        return False
+    return mode == 'segmented' or (
+        procs > 1 and info['duration'] >= current_app.config.get('VIDEO_SEGMENT_MIN_SECONDS', 600))
+
+def split_segments(src, folder, seconds, slots):
+    """Stream-copy the video of ``src`` into keyframe-aligned segments."""
+    import ffmpeg
+    os.makedirs(folder, exist_ok=True)
+    stream = ffmpeg.input(src)['v:0'].output(os.path.join(folder, 'seg_%04d.mp4'), c='copy',
+                                             f='segment', segment_time=seconds, reset_timestamps=1)
+    encode_variant(stream, slots)
+    return sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.startswith('seg_'))
+
+def replayable(rng):
+    """Factory of identical random streams, so every segment gets the same parameters."""
+    if rng is random:
+        rng = random.Random(random.random())
+    state = rng.getstate()
+
+    def fresh():
+        r = random.Random()
+        r.setstate(state)
+        return r
+    return fresh
+
+def build_segment_variant(seg, part, info, opts, threads, rng):
+    import ffmpeg
+    profile = ENCODE_PROFILES[opts.get('encode_profile', 'medium')]
+    w, h = display_size(info)
+    video = video_variant_chain(ffmpeg.input(seg).video, w, h, opts, output_size(w, h, profile), rng)
+    return ffmpeg.output(video, part, **output_args(profile, {**info, 'audio_codec': None}, threads))
+
+def concat_segments(parts, src, outp, info, slots):
+    """Join encoded segments and mux the source's untouched audio back in."""
+    import ffmpeg
+    listing = f'{outp}.txt'
+    with open(listing, 'w') as f:
+        for part in parts:
+            f.write("file '%s'\n" % os.path.abspath(part).replace("'", "'\\''"))
+    video = ffmpeg.input(listing, f='concat', safe=0).video
+    if info.get('audio_codec'):
+        acodec = 'copy' if info['audio_codec'] == 'aac' else 'aac'
+        stream = ffmpeg.output(video, ffmpeg.input(src).audio, outp, vcodec='copy', acodec=acodec)
+    else:
+        stream = ffmpeg.output(video, outp, vcodec='copy')
+    try:
+        encode_variant(stream, slots)
+    finally:
+        for path in parts + [listing]:
+            if os.path.exists(path):
+                os.remove(path)
+
+def encode_variant(stream, slots, outputs=1):
+    """Run one ffmpeg graph writing ``outputs`` files; returns its wall time in seconds."""
+    import ffmpeg
+    try:
+        with slots.hold(outputs):
+            t0 = time.monotonic()
+            ffmpeg.run(stream, overwrite_output=True, capture_stdout=True, capture_stderr=True)
+            elapsed = time.monotonic() - t0
+        metrics.observe('ffmpeg', elapsed)
+        return elapsed
+    except ffmpeg.Error as e:
+        lines = (e.stderr or b'').decode(errors='replace').strip().splitlines()
+        raise RuntimeError(lines[-1] if lines else 'ffmpeg failed') from None
+
+def render_videos(sources, output_folder, opts, on_variant=None, probes=None, stats=None,
+                  checksums=None, variants=None, file_opts=None):
+    """Render ``batch_size`` variants of every ``(path, filename)`` in sources.
+
+    Variants of all files are encoded by a bounded pool of ffmpeg processes,
+    either one process per variant or, for large sources, one process per
+    file that decodes once and splits into every variant (``VIDEO_RENDER_MODE``).
+    Long sources are cut at keyframes and each variant's segments are
+    encoded in parallel with the same parameters, then concatenated with
+    the source audio.
+    Encoder settings come from the ``encode_profile`` option.
+    ``probes`` maps filename to a cached probe.probe() result; missing
+    entries are probed here. ``on_variant``, ``checksums``, ``variants`` and
+    ``file_opts`` are as in render_images.
+    ``stats``, if given, accumulates ``frames`` and ``encode_seconds``.
+    Returns a list of ``(filename, index, error)`` for variants that failed.
+    """
+    procs, threads = ffmpeg_pool_size()
+    slots = ffmpeg_slots()
+    failures = []
+    tasks = {}
+    segmented = {}  # (filename, index) -> parts still encoding for a segmented variant
+    with ThreadPoolExecutor(max_workers=procs, thread_name_prefix='ffmpeg') as pool:
+        for src, filename in sources:
+            fopts = options_for(filename, opts, file_opts)
+            indices = wanted_indices(filename, fopts, variants)
+            if not indices:
+                continue
+            try:
+                info = (probes or {}).get(filename) or probe.probe(src, 'video')
+            except probe.UnsupportedMedia as e:
+                for i in indices:
+                    failures.append((filename, i, str(e)))
+                    if on_variant:
+                        on_variant(filename, i, str(e), None)
+                continue
+            sha256 = source_sha256(checksums, filename, src)
+            outps = {i: os.path.join(output_folder, variant_name(filename, i, '.mp4')) for i in indices}
+            rngs = [variant_rng(fopts, sha256, i) for i in indices]
+            frames = info.get('duration', 0) * info.get('fps', 0)
+            segments = []
+            if use_segments(info, procs):
+                seg_dir = os.path.join(output_folder, f'{os.path.splitext(filename)[0]}_segments')
+                try:
+                    segments = split_segments(src, seg_dir, current_app.config.get('VIDEO_SEGMENT_SECONDS', 60),
+                                              slots)
+                except RuntimeError:
+                    segments = []  # fall back to whole-file encodes
+            if len(segments) > 1:
+                for i, rng in zip(indices, rngs):
+                    fresh = replayable(rng)
+                    parts = [f'{outps[i]}.part{k:04d}.mp4' for k in range(len(segments))]
+                    segmented[(filename, i)] = {'left': len(parts), 'error': None, 'parts': parts,
+                                                'src': src, 'info': info, 'frames': frames}
+                    for seg, part in zip(segments, parts):
+                        stream = build_segment_variant(seg, part, info, fopts, threads, fresh())
+                        tasks[pool.submit(encode_variant, stream, slots)] = (filename, [i], outps, 0)
+            elif len(indices) > 1 and use_split_graph(info['width'], info['height'], fopts):
+                # one slot per encoder, so each gets the threads a per-variant encode would
+                stream = build_split_variants(src, [outps[i] for i in indices], info, fopts, threads, rngs)
+                tasks[pool.submit(encode_variant, stream, slots, len(indices))] = (
+                    filename, indices, outps, frames)
+            else:
+                for i, rng in zip(indices, rngs):
+                    stream = build_video_variant(src, outps[i], info, fopts, threads, rng)
+                    tasks[pool.submit(encode_variant, stream, slots)] = (filename, [i], outps, frames)
+        for fut in as_completed(tasks):
+            filename, indices, outps, frames = tasks[fut]
+            error = str(fut.exception()) if fut.exception() else None
+            if not error and stats is not None:
+                stats['frames'] = stats.get('frames', 0) + frames * len(indices)
+                stats['encode_seconds'] = stats.get('encode_seconds', 0) + fut.result()
+            for i in indices:
+                seg = segmented.get((filename, i))
+                if seg:
+                    # a segmented variant is done once its last segment is
+                    seg['error'] = seg['error'] or error
+                    seg['left'] -= 1
+                    if seg['left']:
+                        continue
+                    error = seg['error']
+                    if not error:
+                        try:
+                            concat_segments(seg['parts'], seg['src'], outps[i], seg['info'], slots)
+                            if stats is not None:
+                                stats['frames'] = stats.get('frames', 0) + seg['frames']
+                        except RuntimeError as e:
+                            error = str(e)
+                if error:
+                    failures.append((filename, i, error))
+                if on_variant:
+                    on_variant(filename, i, error, None if error else outps[i])
+    return failures
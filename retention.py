@@ -0,0 +1,285 @@
+"""Retention and garbage collection for job artifacts.
+
+A background thread (embedded in the web process, or ``python retention.py``)
+wakes every ``RETENTION_INTERVAL`` seconds and does a bounded slice of work:
+
+* history outputs older than the owner's plan allows, then the oldest
+  outputs beyond the plan's storage quota (a few users per tick);
+* spool dirs in ``uploads/`` and staging dirs in ``processed/`` that no
+  queued or running job owns, plus stale pending backups no longer queued;
+* stored job zips older than ``ZIP_RETENTION_DAYS``;
+* batch API sources unused for ``SOURCE_RETENTION_DAYS``;
+* one shard of the blob store, of the result cache and of the probe cache
+  (files unused for ``PROBE_RETENTION_DAYS``) per tick;
+* the least recently served thumbnails once they total over ``THUMB_CACHE_MB``.
+
+Every unlink goes through a rate limiter (``RETENTION_IOPS``) and the
+thread runs at a lower CPU (and so I/O) priority, so sweeping never
+competes with running encodes.
+
+Only one process per host sweeps: every gunicorn worker starts the thread,
+but it waits for an flock() lease on ``RETENTION_LEASE`` and the first to
+get it keeps it until it exits. With several hosts sharing a database, set
+``RETENTION_EMBEDDED=0`` and run ``python retention.py`` on one of them.
+Age and quota limits per plan live in admission.PLAN_LIMITS.
+"""
+from dotenv import load_dotenv
+import os
+
+load_dotenv()
+
+import datetime
+import fcntl
+import logging
+import shutil
+import threading
+import time
+import traceback
+
+log = logging.getLogger(__name__)
+
+USERS_PER_TICK = 50
+BACKUP_PENDING_FOLDER = os.path.join('backups', 'pending')
+RETENTION_LEASE = os.path.join('storage', 'retention.lock')
+
+_thread = None
+_thread_lock = threading.Lock()
+
+def get_models():
+    from app import db, Job, User, ProcessedFile
+    return db, Job, User, ProcessedFile
+
+class RateLimiter:
+    """Blocks so that calls average at most ``rate`` per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next = time.monotonic()
+
+    def __call__(self):
+        now = time.monotonic()
+        if self.next > now:
+            time.sleep(self.next - now)
+        self.next = max(now, self.next) + self.interval
+
+def _unlink(path, pace):
+    pace()
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+
+def _remove_tree(path, pace):
+    freed = 0
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            freed += _unlink(os.path.join(root, name), pace)
+        for name in dirs:
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)  # already emptied
+    shutil.rmtree(path, ignore_errors=True)
+    return freed
+
+def _mtime(entry):
+    try:
+        return entry.stat(follow_symlinks=False).st_mtime
+    except FileNotFoundError:
+        return None  # removed while we were looking
+
+# -------------------- History --------------------
+def delete_output(row, pace):
+    from processing import HISTORY_FOLDER
+    db, _, _, _ = get_models()
+    freed = _unlink(os.path.join(HISTORY_FOLDER, row.filename), pace)
+    db.session.delete(row)
+    return freed
+
+def enforce_user(user, budget, pace, now=None):
+    """Apply age and quota policy to one user; returns outputs deleted."""
+    from admission import limits_for
+    db, _, _, ProcessedFile = get_models()
+    policy = limits_for(user.plan)
+    cutoff = (now or datetime.datetime.utcnow()) - datetime.timedelta(days=policy['history_days'])
+    oldest_first = (ProcessedFile.query.filter_by(user_id=user.id)
+                    .order_by(ProcessedFile.created_at, ProcessedFile.id))
+    deleted = 0
+    for row in oldest_first.filter(ProcessedFile.created_at < cutoff).limit(budget).all():
+        delete_output(row, pace)
+        deleted += 1
+    db.session.commit()
+    used = (db.session.query(db.func.coalesce(db.func.sum(ProcessedFile.size), 0))
+            .filter(ProcessedFile.user_id == user.id).scalar())
+    over = used - policy['quota_mb'] * 1024 * 1024
+    if over > 0:
+        for row in oldest_first.limit(budget - deleted).all():
+            if over <= 0:
+                break
+            over -= row.size
+            delete_output(row, pace)
+            deleted += 1
+        db.session.commit()
+    return deleted
+
+class Sweeper:
+    def __init__(self, config):
+        self.config = config
+        self.pace = RateLimiter(config['RETENTION_IOPS'])
+        self.user_cursor = 0
+        self.shard = 0
+
+    def sweep_history(self):
+        db, _, User, _ = get_models()
+        users = (User.query.filter(User.id > self.user_cursor).order_by(User.id)
+                 .limit(USERS_PER_TICK).all())
+        self.user_cursor = users[-1].id if len(users) == USERS_PER_TICK else 0
+        budget = self.config['RETENTION_BATCH']
+        for user in users:
+            budget -= enforce_user(user, budget, self.pace)
+            if budget <= 0:
+                break
+
+    # -------------------- Work Dirs --------------------
+    def sweep_orphans(self):
+        """Remove spool/staging dirs no live job owns and stale pending backups."""
+        import backup
+        from jobs import SPOOL_FOLDER
+        db, Job, _, _ = get_models()
+        live = {j for (j,) in db.session.query(Job.id).filter(Job.status.in_(('queued', 'running')))}
+        cutoff = time.time() - self.config['ORPHAN_GRACE']
+        for folder in (SPOOL_FOLDER, 'processed'):
+            if not os.path.isdir(folder):
+                continue
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    mtime = _mtime(entry)
+                    if entry.name in live or mtime is None or mtime > cutoff:
+                        continue
+                    log.info('removing orphan %s', entry.path)
+                    if entry.is_dir(follow_symlinks=False):
+                        _remove_tree(entry.path, self.pace)
+                    else:
+                        _unlink(entry.path, self.pace)
+        if os.path.isdir(BACKUP_PENDING_FOLDER):
+            queued = backup.queued_paths()
+            with os.scandir(BACKUP_PENDING_FOLDER) as entries:
+                for entry in entries:
+                    if os.path.abspath(entry.path) in queued:
+                        continue  # still to be uploaded, after a restart perhaps
+                    if (_mtime(entry) or cutoff) < cutoff:
+                        _unlink(entry.path, self.pace)
+
+    def sweep_zips(self):
+        import backup
+        from jobs import ZIP_FOLDER
+        db, Job, _, _ = get_models()
+        cutoff = time.time() - self.config['ZIP_RETENTION_DAYS'] * 86400
+        budget = self.config['RETENTION_BATCH']
+        queued = backup.queued_paths()
+        with os.scandir(ZIP_FOLDER) as entries:
+            for entry in entries:
+                if budget <= 0:
+                    break
+                if (_mtime(entry) or cutoff) < cutoff and os.path.abspath(entry.path) not in queued:
+                    _unlink(entry.path, self.pace)
+                    Job.query.filter_by(zip_filename=entry.name).update(
+                        {'zip_filename': None}, synchronize_session=False)
+                    budget -= 1
+        db.session.commit()
+
+    def sweep_sources(self):
+        from batch import SOURCE_FOLDER
+        cutoff = time.time() - self.config['SOURCE_RETENTION_DAYS'] * 86400
+        budget = self.config['RETENTION_BATCH']
+        if not os.path.isdir(SOURCE_FOLDER):
+            return
+        with os.scandir(SOURCE_FOLDER) as users:
+            for user in users:
+                with os.scandir(user.path) as entries:
+                    for entry in entries:
+                        if budget <= 0:
+                            return
+                        if (_mtime(entry) or cutoff) < cutoff:
+                            _remove_tree(entry.path, self.pace)
+                            budget -= 1
+
+    def sweep_store(self):
+        import probe
+        import storage
+        shard = f'{self.shard:02x}'
+        self.shard = (self.shard + 1) % 256
+        storage.sweep(self.config['ORPHAN_GRACE'], shard=shard, pace=self.pace)
+        storage.sweep_results(shard=shard, pace=self.pace)
+        probe.sweep(self.config['PROBE_RETENTION_DAYS'] * 86400, shard=shard, pace=self.pace)
+
+    def sweep_thumbs(self):
+        import thumbnails
+        thumbnails.evict(self.config['THUMB_CACHE_MB'] * 1024 * 1024, pace=self.pace)
+
+    def tick(self):
+        for step in (self.sweep_history, self.sweep_orphans, self.sweep_zips, self.sweep_sources,
+                     self.sweep_store, self.sweep_thumbs):
+            try:
+                step()
+            except Exception:
+                log.error('retention %s failed:\n%s', step.__name__, traceback.format_exc())
+                get_models()[0].session.rollback()
+
+# -------------------- Daemon --------------------
+def _lower_priority():
+    # on Linux a thread id works as a pid here; I/O priority follows CPU nice
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+    except (AttributeError, OSError):
+        pass
+
+def take_lease():
+    """Open fd holding the host's sweeper lease, or None if another process has it."""
+    os.makedirs(os.path.dirname(RETENTION_LEASE), exist_ok=True)
+    fd = os.open(RETENTION_LEASE, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+def _loop(app):
+    _lower_priority()
+    # the fd stays open (and the lease held) for as long as this process lives
+    lease = take_lease()
+    while lease is None:
+        time.sleep(app.config['RETENTION_INTERVAL'])
+        lease = take_lease()
+    log.info('sweeping in process %s', os.getpid())
+    sweeper = Sweeper(app.config)
+    while True:
+        try:
+            with app.app_context():
+                sweeper.tick()
+        except Exception:
+            app.logger.error('retention error:\n%s', traceback.format_exc())
+        time.sleep(app.config['RETENTION_INTERVAL'])
+
+def ensure_daemon(app):
+    global _thread
+    with _thread_lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_loop, args=(app,), name='retention', daemon=True)
+            _thread.start()
+
+def start_embedded():
+    from flask import current_app
+    if current_app.config['RETENTION_EMBEDDED']:
+        ensure_daemon(current_app._get_current_object())
+
+if __name__ == '__main__':
+    import sys
+    from app import app
+    if '--once' in sys.argv:
+        if take_lease() is None:
+            sys.exit('another process is sweeping')
+        with app.app_context():
+            Sweeper(app.config).tick()
+    else:
+        _loop(app)
@@ -0,0 +1,123 @@
+"""Content-addressed blob store for rendered variants.
+
+Every output is hashed once and renamed into ``storage/blobs/<aa>/<sha256><ext>``;
+identical outputs share one blob. History entries are hard links to the
+blob, never extra copies (a copy is made only when the history folder
+lives on another filesystem). A blob whose only remaining link is itself
+is unreferenced and can be swept.
+
+The result cache maps a render's cache key (see processing.variant_key)
+to the blob it produced, so a repeated request reuses the bytes.
+"""
+import errno
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+BLOB_FOLDER = os.path.join('storage', 'blobs')
+RESULT_FOLDER = os.path.join('storage', 'results')
+
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def blob_path(digest, ext):
+    return os.path.join(BLOB_FOLDER, digest[:2], digest + ext)
+
+def put(path):
+    """Move ``path`` into the store; returns ``(digest, blob_path)``."""
+    ext = os.path.splitext(path)[1].lower()
+    digest = file_sha256(path)
+    dest = blob_path(digest, ext)
+    if os.path.exists(dest):
+        os.remove(path)
+        os.utime(dest)  # keep a reused blob out of the sweep's grace window
+    else:
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(path, dest)
+    return digest, dest
+
+def link(blob, dest):
+    """Expose a blob at ``dest`` without copying it.
+
+    Never replaces anything: raises FileExistsError if ``dest`` exists, as
+    it may be another job's (or user's) file.
+    """
+    try:
+        os.link(blob, dest)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        with open(blob, 'rb') as src, open(dest, 'xb') as dst:
+            shutil.copyfileobj(src, dst)
+
+def _result_path(key):
+    return os.path.join(RESULT_FOLDER, key[:2], f'{key}.json')
+
+def cached_result(key):
+    """``(digest, blob_path)`` previously stored for ``key``, or None."""
+    try:
+        with open(_result_path(key)) as f:
+            entry = json.load(f)
+        dest = blob_path(entry['sha256'], entry['ext'])
+        os.utime(dest)  # keep it out of the sweep's grace window
+    except (OSError, ValueError, KeyError):
+        return None
+    return entry['sha256'], dest
+
+def remember_result(key, digest, ext):
+    path = _result_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'sha256': digest, 'ext': ext}, f)
+    os.replace(tmp, path)
+
+def sweep(grace_seconds=3600, shard=None, pace=None):
+    """Delete blobs nothing links to any more; returns bytes freed.
+
+    ``shard`` limits the walk to one ``<aa>`` directory; ``pace`` is
+    called before each delete (e.g. a rate limiter).
+    """
+    freed = 0
+    cutoff = time.time() - grace_seconds
+    top = os.path.join(BLOB_FOLDER, shard) if shard else BLOB_FOLDER
+    for root, _, files in os.walk(top):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if st.st_nlink == 1 and st.st_mtime < cutoff:
+                if pace:
+                    pace()
+                os.remove(path)
+                freed += st.st_size
+    return freed
+
+def sweep_results(shard=None, pace=None):
+    """Drop result-cache entries whose blob has been swept; returns the count."""
+    dropped = 0
+    top = os.path.join(RESULT_FOLDER, shard) if shard else RESULT_FOLDER
+    for root, _, files in os.walk(top):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                with open(path) as f:
+                    entry = json.load(f)
+                alive = os.path.exists(blob_path(entry['sha256'], entry['ext']))
+            except (OSError, ValueError, KeyError):
+                alive = False
+            if not alive and not name.endswith('.tmp'):
+                if pace:
+                    pace()
+                os.remove(path)
+                dropped += 1
+    return dropped
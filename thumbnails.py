@@ -0,0 +1,135 @@
+"""Lazy thumbnails and video posters for the history page.
+
+A thumbnail is rendered the first time it is asked for and kept in
+``storage/thumbs`` under the output's sha256, width and format. Outputs
+are content-addressed, so a cached thumbnail never goes stale and is
+served with a long-lived ``immutable`` Cache-Control and an ETag. The cache
+is bounded by ``THUMB_CACHE_MB``: the retention sweeper, which only one
+process per host runs, totals the directory every tick and evicts the least
+recently served thumbnails first.
+"""
+import io
+import os
+import threading
+
+from flask import Blueprint, abort, current_app, request, send_file
+from flask_login import login_required, current_user
+
+thumbs_bp = Blueprint('thumbs', __name__)
+
+THUMB_FOLDER = os.path.join('storage', 'thumbs')
+WIDTHS = (320, 640)
+FORMATS = {'webp': ('WEBP', 'image/webp', {'quality': 75, 'method': 4}),
+           'jpg': ('JPEG', 'image/jpeg', {'quality': 80, 'optimize': True})}
+MAX_AGE = 365 * 24 * 3600
+POSTER_SLOTS = threading.BoundedSemaphore(2)  # ffmpeg processes rendering posters
+
+def get_models():
+    from app import ProcessedFile
+    return ProcessedFile
+
+# -------------------- Rendering --------------------
+def image_thumbnail(path, width):
+    from PIL import Image, ImageOps
+    img = Image.open(path)
+    img.draft('RGB', (width, width))  # JPEG: let the decoder downscale by 1/2..1/8
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((width, width * 4))
+    return img.convert('RGB')
+
+def video_poster(path, width):
+    import ffmpeg
+    from PIL import Image
+    with POSTER_SLOTS:
+        for ss in (1, 0):
+            try:
+                data, _ = (ffmpeg.input(path, ss=ss)
+                           .filter('scale', width, -2)
+                           .output('pipe:', vframes=1, format='image2', vcodec='mjpeg')
+                           .run(capture_stdout=True, capture_stderr=True))
+            except ffmpeg.Error:
+                data = b''
+            if data:
+                return Image.open(io.BytesIO(data)).convert('RGB')
+    raise ValueError('no frame to use as a poster')
+
+def render(source, kind, width, fmt, dest):
+    img = image_thumbnail(source, width) if kind == 'image' else video_poster(source, width)
+    pil_format, _, options = FORMATS[fmt]
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp = f'{dest}.{threading.get_ident()}.tmp'
+    img.save(tmp, pil_format, **options)
+    os.replace(tmp, dest)
+    return os.path.getsize(dest)
+
+# -------------------- Cache --------------------
+def thumb_path(sha256, width, fmt):
+    return os.path.join(THUMB_FOLDER, sha256[:2], f'{sha256}_{width}.{fmt}')
+
+def _scan():
+    entries = []
+    for root, _, files in os.walk(THUMB_FOLDER):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    return entries
+
+def evict(limit, pace=None):
+    """Drop the least recently served thumbnails until under 90% of ``limit``.
+
+    Usage is totalled from the directory, so it counts what every process
+    wrote. Returns the number removed; ``pace`` is as in storage.sweep().
+    """
+    entries = _scan()
+    total = sum(size for _, size, _ in entries)
+    if total <= limit:
+        return 0
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= limit * 0.9:
+            break
+        if pace:
+            pace()
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    return removed
+
+# -------------------- Route --------------------
+@thumbs_bp.route('/<filename>')
+@login_required
+def thumbnail(filename):
+    from processing import HISTORY_FOLDER
+    ProcessedFile = get_models()
+    row = ProcessedFile.query.filter_by(user_id=current_user.id, filename=filename).first_or_404()
+    width = request.args.get('w', WIDTHS[0], type=int)
+    if width not in WIDTHS:
+        abort(400)
+    fmt = 'webp' if 'image/webp' in request.headers.get('Accept', '') else 'jpg'
+    dest = thumb_path(row.sha256, width, fmt)
+    etag = f'{row.sha256[:16]}-{width}-{fmt}'
+    if etag in request.if_none_match:
+        resp = current_app.response_class(status=304)
+    else:
+        try:
+            os.utime(dest)  # hit: mark recently served for eviction
+        except FileNotFoundError:
+            try:
+                render(os.path.join(HISTORY_FOLDER, filename), row.kind, width, fmt, dest)
+            except (OSError, ValueError):
+                abort(404)
+        resp = send_file(dest, mimetype=FORMATS[fmt][1], etag=False)
+    resp.set_etag(etag)
+    resp.cache_control.no_cache = None
+    resp.cache_control.private = True
+    resp.cache_control.max_age = MAX_AGE
+    resp.cache_control.immutable = True
+    resp.vary.add('Accept')
+    return resp